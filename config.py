@@ -24,3 +24,76 @@ PLAYLIST_FILE_PATH = os.path.join(STATIC_DIR, "Fresh", "unfiltered.m3u")
 EPG_FILE_PATH = os.path.join(STATIC_DIR, "Fresh", "unfiltered.xml")
 FILTERED_EPG_FILE_PATH = os.path.join(STATIC_DIR, "Fresh", "filtered.xml")
 FILTERED_PLAYLIST_FILE_PATH = os.path.join(STATIC_DIR, "Fresh", "filtered.m3u")
+
+# Pre-parsed state (channel catalog + EPG display-name index) reloaded on startup
+STATE_SNAPSHOT_FILE_PATH = os.path.join(STATIC_DIR, "Fresh", "state.json")
+
+# Startup warm-up is retried with exponential backoff until the playlist is usable
+STARTUP_RETRY_SECONDS = 30
+STARTUP_RETRY_MAX_SECONDS = 1800
+
+# Timeshift: keep a disk-backed ring of recent TS data per live channel so viewers
+# can pause/rewind (/stream/<id>?offset=-300) or join at a time (?at=<unix|ISO|XMLTV>)
+TIMESHIFT_ENABLED = False
+TIMESHIFT_BUFFER_MB = 512
+TIMESHIFT_DIR = os.path.join(BASE_DIR, "timeshift")
+
+# Optional rendition ladder: one FFmpeg process decodes the channel once and writes
+# several outputs. The first entry is served on /stream/<id>, every entry on
+# /stream/<id>/<name>. "copy" passes the source through, otherwise it is re-encoded
+# (scaled to "height" if given). Leave empty for the single re-encoded output.
+STREAM_RENDITIONS = []
+# STREAM_RENDITIONS = [
+#     {"name": "source", "copy": True},
+#     {"name": "720p", "height": 720, "video_bitrate": "3000k"},
+#     {"name": "480p", "height": 480, "video_bitrate": "1200k"},
+# ]
+
+# "ffmpeg" re-encodes every channel through an FFmpeg subprocess. "relay" pulls the
+# upstream MPEG-TS in-process over a pooled HTTP connection and passes it through
+# untouched, falling back to FFmpeg if the upstream is not clean TS.
+# The relay is only used when STREAM_RENDITIONS is empty.
+STREAM_ENGINE = "ffmpeg"
+
+# Admission control (0 disables a limit). Rejected requests get a 503 with Retry-After.
+MAX_VIEWERS_PER_CHANNEL = 0
+EGRESS_BUDGET_MBPS = 0          # total viewer egress, measured from bytes actually sent
+CHANNEL_STARTS_PER_MINUTE = 0   # new upstream sessions (FFmpeg/relay starts)
+
+# EPG refresh interval and incremental-update bookkeeping: a small manifest, the
+# guide index and one file per retained delta, so /epg/changes only reads what it returns
+EPG_REFRESH_HOURS = 24
+EPG_CHANGES_FILE_PATH = os.path.join(STATIC_DIR, "Fresh", "epg_changes.json")
+EPG_INDEX_FILE_PATH = os.path.join(STATIC_DIR, "Fresh", "epg_index.json")
+EPG_DELTAS_DIR = os.path.join(STATIC_DIR, "Fresh", "epg_deltas")
+EPG_DELTA_HISTORY = 48
+
+# XMLTV sources merged into filtered.xml, downloaded concurrently and parsed in parallel.
+# Lower "priority" wins when sources define the same channel or overlapping programmes;
+# lower-priority sources only fill gaps. "url": None is the provider guide of ACCOUNTS[0]
+# (saved as unfiltered.xml). Gzipped guides are detected automatically.
+# "channel_prefix" keeps only channels whose display-name starts with it (None keeps all).
+# Parallelism is one worker process per source: with a single source (the default)
+# the guide is parsed in-process on one core; extra sources use extra cores.
+EPG_SOURCES = [
+    {"name": "provider", "url": None, "priority": 0, "channel_prefix": "|US|"},
+    # {"name": "community", "url": "https://example.org/guide.xml.gz", "priority": 1, "channel_prefix": None},
+]
+EPG_SOURCES_DIR = os.path.join(STATIC_DIR, "Fresh", "sources")
+
+# Recordings scheduled from <programme> entries of the filtered guide
+RECORDINGS_DIR = os.path.join(BASE_DIR, "recordings")
+RECORDINGS_FILE_PATH = os.path.join(RECORDINGS_DIR, "recordings.json")
+RECORDING_PADDING_SECONDS = 60      # start early / stop late by this much
+RECORDING_BUFFER_MB = 4             # write buffer per recording file
+
+# Candidate upstream hosts; "{server}" is replaced by each account's server.
+# A background prober ranks them by connect time, time-to-first-byte and throughput,
+# and downloads/streams use the fastest healthy one, failing over on errors.
+UPSTREAM_HOSTS = [
+    "http://{server}.d4ktv.info:8080",
+]
+UPSTREAM_PROBE_INTERVAL = 300       # seconds between probe rounds
+UPSTREAM_PROBE_PATH = "/get.php?username={username}&password={password}&type=m3u_plus&output=mpegts"
+UPSTREAM_PROBE_BYTES = 256 * 1024   # read at most this much to estimate throughput
+UPSTREAM_FAILURE_COOLDOWN = 60      # seconds a failed host is skipped
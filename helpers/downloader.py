@@ -1,9 +1,12 @@
 import logging
 import os
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from config import EPG_FILE_PATH, EPG_SOURCES_DIR
+from .upstream import ranked_hosts, mark_upstream_failure, is_server_failure
 
-def download_file(url, file_path):
-    """Download a file if it does not already exist."""
+def fetch_file(url, file_path):
+    """Download a file if it does not already exist. Raises requests exceptions."""
     if os.path.exists(file_path):
         logging.info(f"File already exists: {file_path}")
         return file_path
@@ -16,27 +19,79 @@ def download_file(url, file_path):
             for chunk in response.iter_content(chunk_size=8192):
                 file.write(chunk)
         logging.info(f"File saved to: {file_path}")
+    except requests.exceptions.RequestException:
+        # Don't leave a partial file behind; it would look like a finished download
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+
+    return file_path
+
+
+def download_file(url, file_path):
+    """Download a file if it does not already exist. Returns None on failure."""
+    try:
+        return fetch_file(url, file_path)
     except requests.exceptions.RequestException as e:
         logging.error(f"Failed to download file from {url}: {e}")
         return None
 
-    return file_path
+
+def download_from_upstream(account, path_and_query, file_path):
+    """
+    Download from the fastest healthy upstream host, failing over to the others.
+    Only server-side failures bench a host; a 401/404 is the request's fault.
+    """
+    for base_url in ranked_hosts(account):
+        url = f"{base_url}/{path_and_query}"
+        try:
+            return fetch_file(url, file_path)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Failed to download file from {url}: {e}")
+            if is_server_failure(e):
+                mark_upstream_failure(base_url)
+    return None
 
 
 def download_m3u(account, playlist_file_path):
     """Download the M3U playlist file."""
-    playlist_url = (
-        f"http://{account['server']}.d4ktv.info:8080/"
+    return download_from_upstream(
+        account,
         f"get.php?username={account['username']}&password={account['password']}"
-        "&type=m3u_plus&output=mpegts"
+        "&type=m3u_plus&output=mpegts",
+        playlist_file_path
     )
-    return download_file(playlist_url, playlist_file_path)
 
 
 def download_epg(account, epg_file_path):
     """Download the EPG file."""
-    epg_url = (
-        f"http://{account['server']}.d4ktv.info:8080/"
-        f"xmltv.php?username={account['username']}&password={account['password']}"
+    return download_from_upstream(
+        account,
+        f"xmltv.php?username={account['username']}&password={account['password']}",
+        epg_file_path
     )
-    return download_file(epg_url, epg_file_path)
+
+
+def epg_source_path(source):
+    """Local file for an EPG source; the provider guide stays at unfiltered.xml."""
+    if not source.get("url"):
+        return EPG_FILE_PATH
+    suffix = ".xml.gz" if source["url"].split("?")[0].endswith(".gz") else ".xml"
+    return os.path.join(EPG_SOURCES_DIR, f"{source['name']}{suffix}")
+
+
+def download_epg_sources(sources, account):
+    """
+    Download every configured EPG source concurrently.
+    Returns [(source, path)] for the sources that are available locally.
+    """
+    def fetch(source):
+        path = epg_source_path(source)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if source.get("url"):
+            return download_file(source["url"], path)
+        return download_epg(account, path)
+
+    with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as pool:
+        paths = list(pool.map(fetch, sources))
+    return [(source, path) for source, path in zip(sources, paths) if path]
@@ -0,0 +1,222 @@
+import os
+import json
+import hashlib
+import logging
+import datetime
+import xml.etree.ElementTree as ET
+from threading import Lock
+
+from config import (
+    FILTERED_EPG_FILE_PATH, EPG_CHANGES_FILE_PATH, EPG_INDEX_FILE_PATH, EPG_DELTAS_DIR, EPG_DELTA_HISTORY
+)
+from .snapshot import file_signature, patch_epg_display_names
+
+changes_lock = Lock()
+INDEX_VERSION = 2  # bump when the digest changes so a stored index is rebuilt, not diffed
+
+
+def programme_key(channel_id, start):
+    return f"{channel_id}|{start}"
+
+
+def split_programme_key(key):
+    channel_id, start = key.rsplit("|", 1)
+    return channel_id, start
+
+
+def _digest(xml):
+    return hashlib.blake2b(xml.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _element_xml(elem):
+    elem.tail = None
+    return ET.tostring(elem, encoding="unicode")
+
+
+def index_guide(epg_path):
+    """
+    Stream through an XMLTV file and return {"channels": {id: digest},
+    "programmes": {"channel|start": digest}} without keeping the tree in memory.
+    Only needed when there is no stored index for the current guide.
+    """
+    channels = {}
+    programmes = {}
+    for _, elem in ET.iterparse(epg_path):
+        if elem.tag == "channel":
+            channels[elem.get("id")] = _digest(_element_xml(elem))
+            elem.clear()
+        elif elem.tag == "programme":
+            programmes[programme_key(elem.get("channel"), elem.get("start"))] = _digest(_element_xml(elem))
+            elem.clear()
+    return {"channels": channels, "programmes": programmes}
+
+
+def index_merged_guide(channel_xml, programme_xml):
+    """The index of a guide from the XML merge_epg_sources wrote, without parsing it again."""
+    return {
+        "channels": {channel_id: _digest(xml) for channel_id, xml in channel_xml.items()},
+        "programmes": {
+            programme_key(channel_id, start): _digest(xml)
+            for (channel_id, start), xml in programme_xml.items()
+        },
+    }
+
+
+def diff_indexes(old, new):
+    """Return added/removed/changed keys for channels and programmes."""
+    delta = {}
+    for kind in ("channels", "programmes"):
+        old_items, new_items = old.get(kind, {}), new.get(kind, {})
+        delta[kind] = {
+            "added": sorted(k for k in new_items if k not in old_items),
+            "removed": sorted(k for k in old_items if k not in new_items),
+            "changed": sorted(k for k, v in new_items.items() if k in old_items and old_items[k] != v),
+        }
+    return delta
+
+
+def delta_is_empty(delta):
+    return not any(keys for kind in delta.values() for keys in kind.values())
+
+
+def _display_names(channel_xml, channel_ids):
+    """display-name -> id for the given channels, from their (small) XML snippets."""
+    display_names = {}
+    for channel_id in channel_ids:
+        disp_elem = ET.fromstring(channel_xml[channel_id]).find("display-name")
+        if disp_elem is not None and disp_elem.text and disp_elem.text.strip():
+            display_names[disp_elem.text.strip()] = channel_id
+    return display_names
+
+
+def _read_json(path, default):
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except Exception as e:
+            logging.error(f"Failed to load {path}: {e}")
+    return default
+
+
+def _write_json(path, payload):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(payload, file, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def delta_path(version):
+    return os.path.join(EPG_DELTAS_DIR, f"{version}.json")
+
+
+def load_changes(changes_path=EPG_CHANGES_FILE_PATH):
+    """The change-log manifest: current version, guide signature and retained delta versions."""
+    return _read_json(changes_path, {"version": 0, "guide_signature": None, "deltas": []})
+
+
+def apply_guide_update(new_guide_path, merged, guide_path=FILTERED_EPG_FILE_PATH):
+    """
+    Diff a freshly filtered guide against the current one, keyed by channel id
+    and by channel + programme start. `merged` is the (channel_xml,
+    programme_xml) returned by build_filtered_epg for new_guide_path, so the
+    new guide is not parsed again. Only if something changed is the new
+    guide moved into place, the delta recorded and the display-name index
+    patched. Returns the delta summary (counts per kind).
+    """
+    with changes_lock:
+        changes = load_changes()
+        old_signature = file_signature(guide_path)
+        old_index = None
+        if changes.get("guide_signature") == old_signature and changes.get("index_version") == INDEX_VERSION:
+            old_index = _read_json(EPG_INDEX_FILE_PATH, None)
+        if old_index is None:
+            # First run, or filtered.xml was replaced behind our back
+            old_index = index_guide(guide_path) if old_signature else {}
+
+        channel_xml, merged_programmes = merged
+        new_index = index_merged_guide(channel_xml, merged_programmes)
+        delta = diff_indexes(old_index, new_index)
+        summary = {kind: {op: len(keys) for op, keys in ops.items()} for kind, ops in delta.items()}
+
+        if delta_is_empty(delta) and old_signature:
+            os.remove(new_guide_path)
+            logging.info("EPG unchanged; keeping the current filtered guide.")
+            return summary
+
+        programme_xml = {
+            programme_key(channel_id, start): xml for (channel_id, start), xml in merged_programmes.items()
+        }
+        display_names = _display_names(channel_xml, delta["channels"]["added"] + delta["channels"]["changed"])
+        os.replace(new_guide_path, guide_path)
+        new_signature = file_signature(guide_path)
+
+        version = changes.get("version", 0) + 1
+        record = {
+            "version": version,
+            "generated_at": datetime.datetime.now().isoformat(),
+            "channels": {
+                "added": [{"id": k, "xml": channel_xml.get(k)} for k in delta["channels"]["added"]],
+                "changed": [{"id": k, "xml": channel_xml.get(k)} for k in delta["channels"]["changed"]],
+                "removed": [{"id": k} for k in delta["channels"]["removed"]],
+            },
+            "programmes": {
+                op: [
+                    dict(zip(("channel", "start"), split_programme_key(k)), **(
+                        {} if op == "removed" else {"xml": programme_xml.get(k)}
+                    ))
+                    for k in delta["programmes"][op]
+                ]
+                for op in ("added", "changed", "removed")
+            },
+        }
+        retained = changes.get("deltas", [])
+        if old_signature:
+            # Without a previous guide the "delta" is the whole guide; clients reload it instead
+            _write_json(delta_path(version), record)
+            retained = retained + [version]
+        for expired in retained[:-EPG_DELTA_HISTORY]:
+            try:
+                os.remove(delta_path(expired))
+            except OSError:
+                pass
+        _write_json(EPG_INDEX_FILE_PATH, new_index)
+        changes.update({
+            "version": version,
+            "guide_signature": new_signature,
+            "index_version": INDEX_VERSION,
+            "deltas": retained[-EPG_DELTA_HISTORY:],
+        })
+        _write_json(EPG_CHANGES_FILE_PATH, changes)
+
+        # Patch the display-name index in place; the caller's refresh_snapshot() persists it
+        stale_ids = set(delta["channels"]["removed"]) | set(delta["channels"]["changed"])
+        patch_epg_display_names(old_signature, new_signature, stale_ids, display_names)
+
+        logging.info(f"EPG updated to version {version}: {summary}")
+        return summary
+
+
+def changes_since(since_version):
+    """
+    Return the deltas after `since_version`, or None if they are no longer
+    retained and the client has to reload the full guide. Only the manifest
+    and the returned deltas are read.
+    """
+    changes = load_changes()
+    version = changes.get("version", 0)
+    retained = changes.get("deltas", [])
+    if since_version >= version:
+        return version, []
+    if not retained or retained[0] > since_version + 1:
+        return version, None
+
+    deltas = []
+    for delta_version in retained:
+        if delta_version > since_version:
+            record = _read_json(delta_path(delta_version), None)
+            if record is None:
+                return version, None
+            deltas.append(record)
+    return version, deltas
@@ -1,11 +1,15 @@
 import logging
 import os
+import multiprocessing
 import re
+import gzip
+import bisect
 import difflib
 import unicodedata
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 
-from .utils import clean_text, normalize_name
+from .utils import clean_text, normalize_name, parse_wall_clock
 
 def advanced_normalize(name):
     if not name:
@@ -127,6 +131,45 @@ def find_closest_display_name(tvg_name, display_name_to_id):
     return display_name_to_id[best_match] if best_score >= 0.8 else None
 
 
+def resolve_extinf(line, epg_display_name_to_id):
+    """
+    Apply the filtered.m3u rules to one #EXTINF line: strip a leading "USA "
+    from tvg-name and insert/replace tvg-ID with the fuzzy-matched EPG channel.
+    """
+    # Optional: remove leading "USA " from tvg-name
+    original_tvg_name_match = re.search(r'tvg-name="([^"]+)"', line)
+    if original_tvg_name_match:
+        original_tvg_name = original_tvg_name_match.group(1)
+        if original_tvg_name.startswith("USA "):
+            new_tvg_name = original_tvg_name.replace("USA ", "", 1)
+            line = line.replace(original_tvg_name, new_tvg_name)
+            # Fuzzy-match using new_tvg_name
+            matched_id = find_closest_display_name(new_tvg_name, epg_display_name_to_id)
+        else:
+            matched_id = find_closest_display_name(original_tvg_name, epg_display_name_to_id)
+
+        if matched_id:
+            # Insert or replace tvg-ID
+            if 'tvg-ID=' in line:
+                line = re.sub(r'tvg-ID="[^"]*"', f'tvg-ID="{matched_id}"', line)
+            else:
+                line = line.replace('tvg-name=', f'tvg-ID="{matched_id}" tvg-name=')
+    return line
+
+
+def read_m3u_entries(content):
+    """Split M3U text into [(extinf_line, url_line)] pairs, in order."""
+    entries = []
+    extinf = None
+    for line in content.splitlines():
+        if line.startswith("#EXTINF"):
+            extinf = line
+        elif extinf is not None:
+            entries.append((extinf, line))
+            extinf = None
+    return entries
+
+
 def filter_m3u(input_path, output_path, epg_display_name_to_id, allowed_groups=None):
     """
     1) Do NOT rename the final tvg-name except remove "USA " at the beginning if it exists.
@@ -164,25 +207,7 @@ def filter_m3u(input_path, output_path, epg_display_name_to_id, allowed_groups=N
 
                 # If keep_all == True, or group_name is in allowed_groups, we keep the channel
                 if keep_all or (group_name and group_name in allowed_groups):
-                    # Optional: remove leading "USA " from tvg-name
-                    original_tvg_name_match = re.search(r'tvg-name="([^"]+)"', line)
-                    if original_tvg_name_match:
-                        original_tvg_name = original_tvg_name_match.group(1)
-                        if original_tvg_name.startswith("USA "):
-                            new_tvg_name = original_tvg_name.replace("USA ", "", 1)
-                            line = line.replace(original_tvg_name, new_tvg_name)
-                            # Fuzzy-match using new_tvg_name
-                            matched_id = find_closest_display_name(new_tvg_name, epg_display_name_to_id)
-                        else:
-                            matched_id = find_closest_display_name(original_tvg_name, epg_display_name_to_id)
-
-                        if matched_id:
-                            # Insert or replace tvg-ID
-                            if 'tvg-ID=' in line:
-                                line = re.sub(r'tvg-ID="[^"]*"', f'tvg-ID="{matched_id}"', line)
-                            else:
-                                line = line.replace('tvg-name=', f'tvg-ID="{matched_id}" tvg-name=')
-
+                    line = resolve_extinf(line, epg_display_name_to_id)
                     filtered.append(line)
                     add_next_line = True
                 else:
@@ -203,39 +228,133 @@ def filter_m3u(input_path, output_path, epg_display_name_to_id, allowed_groups=N
 
 
 
-def filter_epg(input_path, output_path):
-    """
-    Filter EPG XML file based on |US| channels and clean the display names, etc.
-    This part is fairly unchanged from your original code.
-    """
-    if not os.path.exists(input_path):
-        logging.error(f"Input file not found: {input_path}")
-        return
+def open_xmltv(path):
+    """Open an XMLTV file, transparently decompressing gzipped guides."""
+    with open(path, 'rb') as file:
+        magic = file.read(2)
+    return gzip.open(path, 'rb') if magic == b"\x1f\x8b" else open(path, 'rb')
 
-    logging.info(f"Filtering EPG file: {input_path}")
-    try:
-        tree = ET.parse(input_path)
-        root = tree.getroot()
-        allowed_channels = set()
-
-        for channel in root.findall("channel"):
-            display_name_element = channel.find("display-name")
-            if display_name_element is not None:
-                display_name = display_name_element.text if display_name_element.text else ""
-                if display_name.startswith("|US|"):
-                    cleaned_name = clean_text(display_name)
-                    display_name_element.text = cleaned_name
-                    allowed_channels.add(channel.get("id"))
-                else:
-                    root.remove(channel)
 
-        for programme in root.findall("programme"):
-            channel_id = programme.get("channel")
-            if channel_id not in allowed_channels:
-                root.remove(programme)
+def parse_xmltv_time(value):
+    try:
+        return parse_wall_clock(value)
+    except (AttributeError, ValueError):
+        return None
 
-        tree.write(output_path, encoding="utf-8", xml_declaration=True)
-        logging.info(f"Filtered EPG saved to: {output_path}")
 
-    except Exception as e:
-        logging.error(f"Failed to filter EPG file: {e}")
+def parse_epg_source(input_path, channel_prefix=None):
+    """
+    Parse one XMLTV source (runs in a worker process). Keeps channels whose
+    display-name starts with channel_prefix (all if None), cleaning the name
+    with clean_text, and their programmes.
+    Returns (channels, programmes): channels is [(id, xml)] in file order,
+    programmes is [(channel_id, start, start_ts, stop_ts, xml)] where start is
+    the raw XMLTV start attribute.
+    XMLTV lists all channels before the programmes, so programmes of channels
+    that were filtered out are skipped without being serialised.
+    """
+    channels = []
+    programmes = []
+    allowed = set()
+    with open_xmltv(input_path) as file:
+        root = None
+        for event, elem in ET.iterparse(file, events=("start", "end")):
+            if root is None:
+                root = elem
+            if event != "end":
+                continue
+            if elem.tag == "channel":
+                disp_elem = elem.find("display-name")
+                display_name = disp_elem.text if disp_elem is not None and disp_elem.text else ""
+                if channel_prefix is None or display_name.startswith(channel_prefix):
+                    if channel_prefix is not None:
+                        disp_elem.text = clean_text(display_name)
+                    elem.tail = None
+                    channels.append((elem.get("id"), ET.tostring(elem, encoding="unicode")))
+                    allowed.add(elem.get("id"))
+                root.clear()  # drop finished elements so the tree does not grow
+            elif elem.tag == "programme":
+                if elem.get("channel") in allowed:
+                    elem.tail = None
+                    programmes.append((
+                        elem.get("channel"),
+                        elem.get("start"),
+                        parse_xmltv_time(elem.get("start")),
+                        parse_xmltv_time(elem.get("stop")),
+                        ET.tostring(elem, encoding="unicode"),
+                    ))
+                root.clear()
+
+    logging.info(f"Parsed EPG source {input_path}: {len(channels)} channels, {len(programmes)} programmes.")
+    return channels, programmes
+
+
+def merge_epg_sources(parsed_sources, output_path):
+    """
+    Merge parsed sources, given in priority order (best first), into one guide.
+    A channel id is defined by the first source that has it. Programmes of the
+    best source are all kept; lower-priority programmes only fill gaps, i.e.
+    they are dropped if they overlap anything already accepted for the channel.
+    Returns (channel_xml, programme_xml) of the written guide, {id: xml} and
+    {(channel id, start attribute): xml}, so it can be diffed without parsing
+    the output again.
+    """
+    channel_xml = {}                # id -> xml, insertion order = output order
+    accepted = {}                   # channel id -> [(start_ts, stop_ts, start, xml)] sorted by start
+
+    for rank, (channels, programmes) in enumerate(parsed_sources):
+        for channel_id, xml in channels:
+            channel_xml.setdefault(channel_id, xml)
+
+        for channel_id, start_attr, start, stop, xml in programmes:
+            slots = accepted.setdefault(channel_id, [])
+            if rank == 0 or start is None or stop is None:
+                if rank == 0:
+                    slots.append((start or 0, stop or 0, start_attr, xml))
+                continue
+            i = bisect.bisect_left(slots, (start,))
+            overlaps_prev = i > 0 and slots[i - 1][1] > start
+            overlaps_next = i < len(slots) and slots[i][0] < stop
+            if not overlaps_prev and not overlaps_next:
+                slots.insert(i, (start, stop, start_attr, xml))
+
+        if rank == 0:
+            for slots in accepted.values():
+                slots.sort(key=lambda slot: slot[0])
+
+    programme_xml = {}
+    with open(output_path, 'w', encoding='utf-8') as out_file:
+        out_file.write("<?xml version='1.0' encoding='utf-8'?>\n<tv>\n")
+        for xml in channel_xml.values():
+            out_file.write(xml + "\n")
+        for channel_id in channel_xml:
+            for _, _, start_attr, xml in accepted.get(channel_id, []):
+                out_file.write(xml + "\n")
+                programme_xml[(channel_id, start_attr)] = xml
+        out_file.write("</tv>\n")
+
+    logging.info(
+        f"Merged EPG saved to: {output_path} ({len(channel_xml)} channels, {len(programme_xml)} programmes)"
+    )
+    return channel_xml, programme_xml
+
+
+def build_filtered_epg(sources, output_path):
+    """
+    Parse [(source_config, path)] in parallel (one process per source) and
+    merge them by priority into output_path. Returns the merged
+    (channel_xml, programme_xml), see merge_epg_sources.
+    """
+    sources = sorted(sources, key=lambda item: item[0].get("priority", 0))
+    args = [(path, source.get("channel_prefix")) for source, path in sources]
+    if len(args) == 1:
+        parsed = [parse_epg_source(*args[0])]
+    else:
+        # Spawn rather than fork: the server is heavily threaded and a lock held
+        # at fork time (e.g. logging's) could hang the worker
+        with ProcessPoolExecutor(
+            max_workers=min(len(args), os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            parsed = list(pool.map(parse_epg_source, *zip(*args)))
+    return merge_epg_sources(parsed, output_path)
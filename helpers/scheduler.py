@@ -2,12 +2,14 @@ import os
 import logging
 import time
 import schedule
-from helpers.downloader import download_epg
-from helpers.epg_filter import filter_epg
-from config import ACCOUNTS, EPG_FILE_PATH, FILTERED_EPG_FILE_PATH
+from helpers.downloader import download_epg_sources, epg_source_path
+from helpers.epg_filter import build_filtered_epg
+from helpers.epg_diff import apply_guide_update
+from helpers.snapshot import refresh_snapshot
+from config import ACCOUNTS, FILTERED_EPG_FILE_PATH, EPG_REFRESH_HOURS, EPG_SOURCES
 
 def schedule_epg_update():
-    schedule.every(24).hours.do(lambda: update_epg_once())
+    schedule.every(EPG_REFRESH_HOURS).hours.do(lambda: update_epg_once())
     while True:
         schedule.run_pending()
         time.sleep(1)
@@ -17,18 +19,25 @@ def update_epg_once():
     try:
         logging.info("Starting EPG update...")
 
-        # Delete old files to ensure fresh data
-        if os.path.exists(EPG_FILE_PATH):
-            os.remove(EPG_FILE_PATH)
-            logging.info(f"Deleted old EPG file: {EPG_FILE_PATH}")
+        # Delete old raw files to ensure fresh data. The filtered guide is kept:
+        # the new one is diffed against it and only replaces it if something changed.
+        for source in EPG_SOURCES:
+            raw_path = epg_source_path(source)
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+                logging.info(f"Deleted old EPG file: {raw_path}")
 
-        if os.path.exists(FILTERED_EPG_FILE_PATH):
-            os.remove(FILTERED_EPG_FILE_PATH)
-            logging.info(f"Deleted old filtered EPG file: {FILTERED_EPG_FILE_PATH}")
+        sources = download_epg_sources(EPG_SOURCES, ACCOUNTS[0])
+        if not sources:
+            raise RuntimeError("No EPG source could be downloaded")
 
-        download_epg(ACCOUNTS[0], EPG_FILE_PATH)
-        filter_epg(EPG_FILE_PATH, FILTERED_EPG_FILE_PATH)
+        new_filtered_path = f"{FILTERED_EPG_FILE_PATH}.new"
+        merged = build_filtered_epg(sources, new_filtered_path)
 
-        logging.info("EPG update completed successfully.")
+        delta = apply_guide_update(new_filtered_path, merged, FILTERED_EPG_FILE_PATH)
+        refresh_snapshot()
+
+        logging.info(f"EPG update completed successfully: {delta}")
+        return delta
     except Exception as e:
         logging.error(f"Failed to update EPG: {e}")
@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import re
+from threading import Lock
+
+from config import FILTERED_EPG_FILE_PATH, FILTERED_PLAYLIST_FILE_PATH, STATE_SNAPSHOT_FILE_PATH
+from .epg_filter import load_epg_display_names
+
+SNAPSHOT_VERSION = 1
+
+snapshot_lock = Lock()
+runtime_state = {
+    "epg_display_names": {},   # display-name -> EPG channel id
+    "channels": [],            # parsed entries of filtered.m3u
+    "sources": {},             # "epg"/"playlist" -> [mtime_ns, size] the state was built from
+}
+
+
+def file_signature(path):
+    """Return [mtime_ns, size] for path, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def parse_m3u_catalog(playlist_path):
+    """Parse an M3U file into a list of channel dicts (name, tvg-ID, logo, group, url, channel_id)."""
+    channels = []
+    if not os.path.exists(playlist_path):
+        return channels
+
+    with open(playlist_path, 'r', encoding='utf-8', errors='ignore') as file:
+        extinf = None
+        for line in file:
+            line = line.strip()
+            if line.startswith("#EXTINF"):
+                extinf = line
+            elif extinf and line.startswith("http"):
+                def attr(name):
+                    match = re.search(rf'{name}="([^"]*)"', extinf)
+                    return match.group(1) if match else ""
+                channels.append({
+                    "tvg_id": attr("tvg-ID"),
+                    "tvg_name": attr("tvg-name"),
+                    "tvg_logo": attr("tvg-logo"),
+                    "group": attr("group-title"),
+                    "url": line,
+                    "channel_id": line.rstrip("/").split("/")[-1],
+                })
+                extinf = None
+    return channels
+
+
+def save_snapshot(snapshot_path=STATE_SNAPSHOT_FILE_PATH):
+    """Atomically persist the in-memory state so the next start can skip re-parsing."""
+    with snapshot_lock:
+        payload = {"version": SNAPSHOT_VERSION, **runtime_state}
+    tmp_path = f"{snapshot_path}.tmp"
+    try:
+        os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(payload, file, separators=(",", ":"))
+        os.replace(tmp_path, snapshot_path)
+        logging.info(f"State snapshot saved to: {snapshot_path}")
+    except Exception as e:
+        logging.error(f"Failed to save state snapshot: {e}")
+
+
+def load_snapshot(snapshot_path=STATE_SNAPSHOT_FILE_PATH):
+    """Load the last persisted state into memory. Returns True if a snapshot was loaded."""
+    if not os.path.exists(snapshot_path):
+        return False
+    try:
+        with open(snapshot_path, 'r', encoding='utf-8') as file:
+            payload = json.load(file)
+        if payload.get("version") != SNAPSHOT_VERSION:
+            logging.warning("State snapshot version mismatch, ignoring it.")
+            return False
+        with snapshot_lock:
+            for key in runtime_state:
+                runtime_state[key] = payload.get(key, runtime_state[key])
+        logging.info(
+            f"Loaded state snapshot: {len(runtime_state['channels'])} channels, "
+            f"{len(runtime_state['epg_display_names'])} EPG names."
+        )
+        return True
+    except Exception as e:
+        logging.error(f"Failed to load state snapshot: {e}")
+        return False
+
+
+def get_epg_display_names():
+    """
+    Return the display-name -> channel id index for the filtered EPG,
+    re-parsing filtered.xml only if it changed since the index was built.
+    """
+    signature = file_signature(FILTERED_EPG_FILE_PATH)
+    with snapshot_lock:
+        if signature and runtime_state["sources"].get("epg") == signature:
+            return runtime_state["epg_display_names"]
+
+    display_names = load_epg_display_names(FILTERED_EPG_FILE_PATH) if signature else {}
+    with snapshot_lock:
+        runtime_state["epg_display_names"] = display_names
+        runtime_state["sources"]["epg"] = signature
+    return display_names
+
+
+def get_channel_catalog():
+    """Return the parsed filtered.m3u, re-parsing only if the file changed."""
+    signature = file_signature(FILTERED_PLAYLIST_FILE_PATH)
+    with snapshot_lock:
+        if signature and runtime_state["sources"].get("playlist") == signature:
+            return runtime_state["channels"]
+
+    channels = parse_m3u_catalog(FILTERED_PLAYLIST_FILE_PATH)
+    with snapshot_lock:
+        runtime_state["channels"] = channels
+        runtime_state["sources"]["playlist"] = signature
+    return channels
+
+
+def refresh_snapshot():
+    """Bring the in-memory state up to date with the files on disk and persist it."""
+    get_epg_display_names()
+    get_channel_catalog()
+    save_snapshot()
+
+
+def patch_epg_display_names(previous_signature, new_signature, removed_ids, display_names):
+    """
+    Apply a guide delta to the cached EPG index instead of re-parsing filtered.xml.
+    `removed_ids` are channels that were removed or changed, `display_names` maps
+    the display-name of every added or changed channel to its id. Returns False
+    (leaving the index to be rebuilt lazily) if the cache was not built from the
+    previous guide.
+    """
+    with snapshot_lock:
+        if runtime_state["sources"].get("epg") != previous_signature:
+            return False
+        index = {
+            name: channel_id
+            for name, channel_id in runtime_state["epg_display_names"].items()
+            if channel_id not in removed_ids
+        }
+        index.update(display_names)
+        runtime_state["epg_display_names"] = index
+        runtime_state["sources"]["epg"] = new_signature
+    return True
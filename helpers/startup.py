@@ -0,0 +1,104 @@
+import os
+import time
+import logging
+import datetime
+from config import (
+    ACCOUNTS,
+    PLAYLIST_FILE_PATH, EPG_FILE_PATH,
+    FILTERED_EPG_FILE_PATH, FILTERED_PLAYLIST_FILE_PATH,
+    ALLOWED_GROUPS,
+    STARTUP_RETRY_SECONDS, STARTUP_RETRY_MAX_SECONDS
+)
+from helpers.downloader import download_m3u, download_epg
+from helpers.epg_filter import filter_m3u, filter_to_allowed_groups
+from helpers.snapshot import get_epg_display_names, refresh_snapshot, runtime_state
+
+startup_state = {
+    "phase": "starting",       # starting -> warming -> ready (failed while waiting to retry)
+    "snapshot_loaded": False,
+    "started_at": datetime.datetime.now().isoformat(),
+    "ready_at": None,
+    "attempts": 0,
+    "next_retry_at": None,
+    "error": None,
+}
+
+
+def warm_up():
+    """
+    One attempt at downloading/filtering whatever artifacts are missing and
+    rebuilding the state snapshot. Raises if no usable playlist came out of it.
+    """
+    # 1) Check if EPG exists; if not, download it (the playlist is still usable without it)
+    if not os.path.exists(EPG_FILE_PATH):
+        logging.info("No unfiltered.xml found. Downloading EPG now...")
+        if not download_epg(ACCOUNTS[0], EPG_FILE_PATH):
+            logging.error("Failed to download EPG; continuing without it.")
+
+    # 2) unfiltered.m3u check
+    if not os.path.exists(PLAYLIST_FILE_PATH):
+        logging.info("No unfiltered.m3u found. Downloading now...")
+        if not download_m3u(ACCOUNTS[0], PLAYLIST_FILE_PATH):
+            raise RuntimeError("Failed to download the M3U playlist")
+
+        # Immediately remove junk by only keeping ALLOWED_GROUPS in-place
+        filter_to_allowed_groups(
+            PLAYLIST_FILE_PATH,
+            PLAYLIST_FILE_PATH,
+            ALLOWED_GROUPS
+        )
+
+    # 3) filtered.m3u check
+    if not os.path.exists(FILTERED_PLAYLIST_FILE_PATH):
+        logging.info("No filtered.m3u found. Creating now...")
+        epg_display_name_to_id = {}
+        if os.path.exists(FILTERED_EPG_FILE_PATH):
+            epg_display_name_to_id = get_epg_display_names()
+
+        # Now produce filtered.m3u with advanced matching (tvg-ID)
+        filter_m3u(
+            PLAYLIST_FILE_PATH,
+            FILTERED_PLAYLIST_FILE_PATH,
+            epg_display_name_to_id,
+            ALLOWED_GROUPS
+        )
+        if not os.path.exists(FILTERED_PLAYLIST_FILE_PATH):
+            raise RuntimeError("Failed to create filtered.m3u")
+        logging.info("M3U playlist created successfully.")
+
+    # 4) Re-parse only what changed since the snapshot and persist the result
+    refresh_snapshot()
+    if not runtime_state["channels"]:
+        raise RuntimeError("filtered.m3u contains no channels")
+
+
+def initialize():
+    """
+    Warm up in a background thread so the server can bind immediately and keep
+    serving the last-known-good files in the meantime. Failed attempts (e.g. a
+    provider outage) are retried with exponential backoff; /ready stays 503
+    until one succeeds.
+    """
+    delay = STARTUP_RETRY_SECONDS
+    while True:
+        startup_state["phase"] = "warming"
+        startup_state["attempts"] += 1
+        startup_state["next_retry_at"] = None
+        try:
+            warm_up()
+        except Exception as e:
+            startup_state["phase"] = "failed"
+            startup_state["error"] = str(e)
+            startup_state["next_retry_at"] = (
+                datetime.datetime.now() + datetime.timedelta(seconds=delay)
+            ).isoformat()
+            logging.error(f"Startup initialization failed: {e}. Retrying in {delay}s.")
+            time.sleep(delay)
+            delay = min(delay * 2, STARTUP_RETRY_MAX_SECONDS)
+            continue
+
+        startup_state["phase"] = "ready"
+        startup_state["ready_at"] = datetime.datetime.now().isoformat()
+        startup_state["error"] = None
+        logging.info("Startup initialization complete.")
+        return
@@ -4,44 +4,493 @@ import subprocess
 import logging
 import datetime
 import queue
+import threading
+import requests
+from requests.adapters import HTTPAdapter
 from .utils import normalize_name
-from services.channel_manager import release_account_if_inactive
+from .timeshift import TimeshiftBuffer
+from .upstream import ranked_hosts, mark_upstream_failure, is_server_failure, check_upstream
+from config import ACCOUNTS, TIMESHIFT_ENABLED, TIMESHIFT_BUFFER_MB, TIMESHIFT_DIR, STREAM_RENDITIONS, STREAM_ENGINE
+from services.account_management import find_available_account, lock_account, release_account, account_locks
+from services.channel_manager import (
+    channel_to_process,
+    channel_to_account,
+    channel_viewers_queues,
+    channel_timeshift,
+    channel_sinks,
+    last_buffer_update,
+    release_account_if_inactive,
+    channel_has_consumers,
+    viewer_renditions
+)
 
-def start_ffmpeg_stream(channel_id, input_url):
+X264_ARGS = ["-c:v", "libx264", "-preset", "ultrafast", "-tune", "zerolatency"]
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+RELAY_CHUNK_SIZE = TS_PACKET_SIZE * 256
+READ_CHUNK_SIZE = TS_PACKET_SIZE * 348  # ~64 KiB of whole TS packets per FFmpeg read (at most)
+READ_ARENA_SIZE = 1024 * 1024  # FFmpeg output is read into arenas of this size, see TSChunkReader
+RELAY_PROBE_BYTES = 256 * 1024  # give up on relaying if no TS sync is found within this much data
+
+# Serializes the check-then-start of a channel across viewers and the recorder
+channel_start_lock = threading.Lock()
+
+# Upstream connections are pooled and kept alive across channel starts
+upstream_session = requests.Session()
+upstream_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+upstream_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+
+def build_rendition_args(renditions, outputs):
+    """
+    Build the FFmpeg output arguments for a rendition ladder: the video is
+    decoded once, split, and each re-encoded rendition is scaled from the split.
+    """
+    encoded = [r for r in renditions if not r.get("copy")]
+    args = []
+    if encoded:
+        labels = "".join(f"[v{i}]" for i in range(len(encoded)))
+        chains = [f"[0:v]split={len(encoded)}{labels}"]
+        for i, rendition in enumerate(encoded):
+            scale = f"scale=-2:{rendition['height']}" if rendition.get("height") else "null"
+            chains.append(f"[v{i}]{scale}[out{i}]")
+        args += ["-filter_complex", ";".join(chains)]
+
+    encoded_index = 0
+    for rendition, output in zip(renditions, outputs):
+        if rendition.get("copy"):
+            args += ["-map", "0:v", "-map", "0:a?", "-c", "copy"]
+        else:
+            args += ["-map", f"[out{encoded_index}]", "-map", "0:a?"] + X264_ARGS + ["-c:a", "copy"]
+            if rendition.get("video_bitrate"):
+                args += ["-b:v", rendition["video_bitrate"]]
+            encoded_index += 1
+        args += ["-f", "mpegts", output]
+    return args
+
+
+def start_ffmpeg_stream(channel_id, input_url, renditions=None):
+    """
+    Start FFmpeg for a channel. `process.renditions` maps each rendition name to
+    the readable pipe carrying it; the first entry is the default. Without a
+    ladder there is a single re-encoded rendition on stdout named None.
+    """
     logging.debug(f"Starting FFmpeg for channel {channel_id} with URL {input_url}.")
-    return subprocess.Popen(
-        [
-            "ffmpeg", "-re", "-fflags", "+nobuffer", "-flags", "low_delay",
-            "-i", input_url,
-            "-c:v", "libx264", "-preset", "ultrafast", "-tune", "zerolatency",
-            "-f", "mpegts", "-"
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.DEVNULL,
-    )
+    input_args = ["ffmpeg", "-re", "-fflags", "+nobuffer", "-flags", "low_delay", "-i", input_url]
 
+    if not renditions:
+        process = subprocess.Popen(
+            input_args + X264_ARGS + ["-f", "mpegts", "-"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        process.renditions = {None: process.stdout}
+        return process
 
-def fetch_from_ffmpeg(channel_id, process, channel_viewers_queues, last_buffer_update, release_account_if_inactive):
+    # First rendition goes to stdout, the others to extra pipes inherited by FFmpeg
+    pipes = [os.pipe() for _ in renditions[1:]]
+    outputs = ["-"] + [f"pipe:{write_fd}" for _, write_fd in pipes]
+    try:
+        process = subprocess.Popen(
+            input_args + build_rendition_args(renditions, outputs),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            pass_fds=[write_fd for _, write_fd in pipes],
+        )
+    except Exception:
+        for read_fd, write_fd in pipes:
+            os.close(read_fd)
+            os.close(write_fd)
+        raise
+
+    process.renditions = {renditions[0]["name"]: process.stdout}
+    for rendition, (read_fd, write_fd) in zip(renditions[1:], pipes):
+        os.close(write_fd)
+        process.renditions[rendition["name"]] = os.fdopen(read_fd, "rb")
+    return process
+
+
+class TSChunkReader:
+    """
+    Reads a TS pipe with readinto straight into a preallocated arena and hands
+    out consecutive, 188-byte aligned memoryviews of it. A view is never
+    overwritten, so viewers, the timeshift buffer etc. can all hold it without
+    copying; a new arena is only allocated once the current one is full. Small
+    reads (a pipe often has just a few packets ready) therefore share an arena
+    instead of each pinning a buffer of their own.
+    """
+
+    def __init__(self, stream, arena_size=READ_ARENA_SIZE, chunk_size=READ_CHUNK_SIZE):
+        self.stream = stream
+        self.arena_size = max(arena_size, chunk_size)
+        self.chunk_size = chunk_size
+        self._readinto = getattr(stream, "readinto1", stream.readinto)
+        self._arena = None
+        self._pos = 0
+
+    def read(self):
+        """Return the next chunk as a memoryview, or None at EOF."""
+        if self._arena is None or self.arena_size - self._pos < self.chunk_size:
+            self._arena = memoryview(bytearray(self.arena_size))
+            self._pos = 0
+        # chunk_size is a whole number of packets, so completing the last one stays inside it
+        view = self._arena[self._pos:self._pos + self.chunk_size]
+        n = self._readinto(view)
+        if not n:
+            return None
+        while n % TS_PACKET_SIZE:
+            more = self.stream.readinto(view[n:n + TS_PACKET_SIZE - n % TS_PACKET_SIZE])
+            if not more:
+                break
+            n += more
+        self._pos += n
+        return view[:n]
+
+
+def write_sinks(channel_id, data):
+    """Hand a chunk to the channel's internal consumers (recordings) on the reader thread."""
+    for sink in list(channel_sinks.get(channel_id, {}).values()):
+        try:
+            sink.write(data)
+        except Exception as e:
+            logging.error(f"Sink write failed for channel {channel_id}: {e}")
+
+
+def fan_out(channel_id, data, channel_viewers_queues, rendition=None):
+    """Queue a chunk for every viewer of the channel (that selected `rendition`, if any)."""
+    for viewer_id, q in list(channel_viewers_queues.get(channel_id, {}).items()):
+        if rendition is not None and viewer_renditions.get(viewer_id) != rendition:
+            continue
+        try:
+            # Never block the channel on one slow viewer; it just loses this chunk
+            q.put_nowait(data)
+        except queue.Full:
+            pass
+
+
+def fetch_from_ffmpeg(channel_id, process, channel_viewers_queues, last_buffer_update, release_account_if_inactive,
+                      timeshift_buffers=None, rendition=None, stream=None):
+    """
+    Fan out one FFmpeg output to the channel's viewers. With a rendition ladder
+    there is one of these per rendition; only viewers that selected `rendition`
+    receive its data, and only the default rendition feeds the timeshift buffer
+    and releases the channel when it ends. Every output must be drained, even
+    without viewers, or FFmpeg stalls on the full pipe.
+    """
+    stream = stream or process.stdout
+    is_default = rendition == next(iter(getattr(process, "renditions", {None: None})))
+    timeshift = timeshift_buffers.get(channel_id) if timeshift_buffers is not None and is_default else None
+    reader = TSChunkReader(stream)
+    received_any = False
+    failed_over = False
     while True:
         try:
-            data = process.stdout.read(4096)
-            if not data:
+            data = reader.read()
+            if data is None:
                 # Possibly handle error here. But since stderr=DEVNULL, skip reading it.
                 logging.error(f"FFmpeg: No more data for channel {channel_id}. Maybe stream ended.")
+                upstream_base = getattr(process, "upstream_base", None)
+                if is_default and not received_any and upstream_base and check_upstream(process.input_url):
+                    # Nothing ever came through because the host failed (not e.g. an unknown
+                    # channel id): bench it and move the channel's viewers to the next host
+                    mark_upstream_failure(upstream_base)
+                    failed_over = fail_over_ffmpeg(channel_id, process)
                 break
+            received_any = True
 
             last_buffer_update[channel_id] = datetime.datetime.now()
-            if channel_id in channel_viewers_queues:
-                for q in channel_viewers_queues[channel_id].values():
-                    try:
-                        q.put(data, timeout=1)
-                    except queue.Full:
-                        pass
+            if timeshift:
+                timeshift.write(data)
+            if is_default:
+                write_sinks(channel_id, data)
+            fan_out(channel_id, data, channel_viewers_queues, rendition)
 
         except Exception as e:
             logging.error(f"Error fetching data for channel {channel_id}: {e}")
             break
 
     # Once we exit the loop, the stream is effectively done:
-    logging.debug(f"Stream fetching stopped for channel {channel_id}.")
-    release_account_if_inactive(channel_id)
+    logging.debug(f"Stream fetching stopped for channel {channel_id} (rendition {rendition}).")
+    if stream is not process.stdout:
+        stream.close()
+    if is_default and not failed_over:
+        release_account_if_inactive(channel_id, process)
+
+
+class RelaySession:
+    """
+    Stands in for the FFmpeg Popen in channel_to_process when a channel is
+    relayed in-process, so teardown can keep calling poll()/kill().
+    """
+
+    def __init__(self, channel_id, input_url, upstream_base=None, alternates=()):
+        self.channel_id = channel_id
+        self.input_url = input_url
+        self.upstream_base = upstream_base
+        self.alternates = list(alternates)  # [(base_url, input_url)] to fail over to
+        self.renditions = {None: None}
+        self.response = None
+        self.ffmpeg = None  # set if we had to fall back
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()  # orders attach_ffmpeg() against kill()
+
+    @property
+    def stdout(self):
+        return self.ffmpeg.stdout if self.ffmpeg else None
+
+    def poll(self):
+        if self.ffmpeg:
+            return self.ffmpeg.poll()
+        return 0 if self._stopped.is_set() else None
+
+    def attach_ffmpeg(self, process):
+        """Hand the session over to a fallback FFmpeg. Returns False if it was stopped meanwhile."""
+        with self._lock:
+            if self._stopped.is_set():
+                return False
+            self.ffmpeg = process
+            return True
+
+    def kill(self):
+        with self._lock:
+            self._stopped.set()
+            ffmpeg = self.ffmpeg
+        if self.response is not None:
+            self.response.close()
+        if ffmpeg and ffmpeg.poll() is None:
+            ffmpeg.kill()
+
+
+def find_ts_sync(data, start=0):
+    """Return the offset of the first byte that starts three consecutive TS packets, or -1."""
+    i = data.find(TS_SYNC_BYTE, start)
+    while i != -1 and i + 2 * TS_PACKET_SIZE < len(data):
+        if data[i + TS_PACKET_SIZE] == TS_SYNC_BYTE and data[i + 2 * TS_PACKET_SIZE] == TS_SYNC_BYTE:
+            return i
+        i = data.find(TS_SYNC_BYTE, i + 1)
+    return -1
+
+
+def connect_upstream(session):
+    """
+    Open the upstream stream for a relay session, failing over to the next
+    candidate host on connection errors, timeouts and 5xx responses.
+    """
+    candidates = [(session.upstream_base, session.input_url)] + session.alternates
+    for i, (base_url, input_url) in enumerate(candidates):
+        is_last = i == len(candidates) - 1
+        try:
+            response = upstream_session.get(input_url, stream=True, timeout=(5, 20))
+            if response.status_code >= 500:
+                response.close()
+                raise requests.HTTPError(f"upstream answered {response.status_code}", response=response)
+            response.raise_for_status()
+            session.upstream_base, session.input_url = base_url, input_url
+            return response
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            server_side = is_server_failure(e)
+            if base_url and server_side:
+                mark_upstream_failure(base_url)
+            if is_last or not server_side:
+                raise
+            logging.warning(f"Relay: upstream {base_url} failed ({e}), trying the next host.")
+
+
+def relay_ts_stream(channel_id, session, channel_viewers_queues, last_buffer_update, release_account_if_inactive,
+                    timeshift_buffers=None):
+    """
+    Pull the upstream MPEG-TS directly and fan out whole 188-byte packets,
+    re-syncing on packet boundaries if the stream is corrupted. If no TS sync
+    can be found (HLS playlist, HTML error page, ...) fall back to FFmpeg.
+    """
+    timeshift = timeshift_buffers.get(channel_id) if timeshift_buffers is not None else None
+    pending = bytearray()
+    synced = False
+    relayed_any = False
+    connected = False
+    probed = 0
+
+    try:
+        session.response = connect_upstream(session)
+        connected = True
+
+        for chunk in session.response.iter_content(chunk_size=RELAY_CHUNK_SIZE):
+            if session.poll() is not None:
+                break
+            pending += chunk
+
+            if not synced:
+                offset = find_ts_sync(pending)
+                if offset == -1:
+                    probed += len(chunk)
+                    if not relayed_any and probed > RELAY_PROBE_BYTES:
+                        break  # not clean TS, hand over to FFmpeg below
+                    del pending[:max(len(pending) - 2 * TS_PACKET_SIZE, 0)]
+                    continue
+                if offset:
+                    logging.debug(f"Relay: re-synced channel {channel_id}, dropped {offset} bytes.")
+                del pending[:offset]
+                synced = True
+
+            packet_bytes = len(pending) - len(pending) % TS_PACKET_SIZE
+            # Every packet must start with the sync byte; cut at the first one that does not
+            sync_bytes = bytes(pending[0:packet_bytes:TS_PACKET_SIZE])
+            good_packets = len(sync_bytes) - len(sync_bytes.lstrip(b"\x47"))
+            if good_packets < len(sync_bytes):
+                packet_bytes = good_packets * TS_PACKET_SIZE
+                synced = False
+
+            # Hand the aligned packets over as a view of this buffer (no copy) and
+            # carry only the partial packet (or the bad byte) into a new one
+            data = memoryview(pending)[:packet_bytes]
+            pending = bytearray(pending[packet_bytes + (0 if synced else 1):])
+            if not packet_bytes:
+                continue
+
+            relayed_any = True
+            last_buffer_update[channel_id] = datetime.datetime.now()
+            if timeshift:
+                timeshift.write(data)
+            write_sinks(channel_id, data)
+            fan_out(channel_id, data, channel_viewers_queues)
+
+    except Exception as e:
+        if session.poll() is None:
+            logging.error(f"Relay error for channel {channel_id}: {e}")
+    finally:
+        if session.response is not None:
+            session.response.close()
+
+    # Only a failed TS probe falls back; if no host could be reached, FFmpeg would fail too
+    if connected and not relayed_any and session.poll() is None:
+        # Upstream is not plain TS: the account is still ours, let FFmpeg handle it
+        logging.info(f"Relay: no clean MPEG-TS for channel {channel_id}, falling back to FFmpeg.")
+        try:
+            ffmpeg = start_ffmpeg_stream(channel_id, session.input_url)
+        except Exception as e:
+            logging.error(f"Failed to start FFmpeg fallback for channel {channel_id}: {e}")
+        else:
+            if not session.attach_ffmpeg(ffmpeg):
+                # The last consumer left while FFmpeg was starting; the channel is already torn down
+                logging.debug(f"Channel {channel_id} stopped during FFmpeg fallback, killing it.")
+                ffmpeg.kill()
+                return
+            # The session stays registered for the channel and now reads FFmpeg's stdout
+            fetch_from_ffmpeg(channel_id, session, channel_viewers_queues, last_buffer_update,
+                              release_account_if_inactive, timeshift_buffers=timeshift_buffers)
+            return
+
+    logging.debug(f"Relay stopped for channel {channel_id}.")
+    release_account_if_inactive(channel_id, session)
+
+
+def start_channel(channel_id):
+    """
+    Lock an account and start the upstream session (FFmpeg or relay) for a
+    channel, with its reader threads. Returns (session, None) on success, or
+    (None, error) with a message suitable for a 503. If the channel is already
+    running its session is returned, so concurrent callers (viewers, the
+    recorder) never start a second one.
+    """
+    with channel_start_lock:
+        process = channel_to_process.get(channel_id)
+        if process is not None:
+            return process, None
+        return _start_channel_locked(channel_id)
+
+
+def start_ffmpeg_on(channel_id, upstreams):
+    """Start FFmpeg on the first of [(base_url, input_url)]; the others are kept to fail over to."""
+    (upstream_base, input_url), alternates = upstreams[0], upstreams[1:]
+    process = start_ffmpeg_stream(channel_id, input_url, STREAM_RENDITIONS)
+    process.upstream_base, process.input_url, process.alternates = upstream_base, input_url, alternates
+    return process
+
+
+def start_ffmpeg_readers(channel_id, process):
+    # One reader per rendition output
+    for name, output in process.renditions.items():
+        threading.Thread(
+            target=fetch_from_ffmpeg,
+            args=(channel_id, process, channel_viewers_queues, last_buffer_update, release_account_if_inactive),
+            kwargs={"timeshift_buffers": channel_timeshift, "rendition": name, "stream": output},
+            daemon=True
+        ).start()
+
+
+def fail_over_ffmpeg(channel_id, process):
+    """
+    Replace a channel's FFmpeg whose host sent nothing with one on the next
+    candidate host, keeping the account, viewers and timeshift buffer, so the
+    viewers already waiting do not get a dead stream. Returns True if the
+    channel now runs on the replacement.
+    """
+    alternates = getattr(process, "alternates", None)
+    if not alternates or isinstance(process, RelaySession):
+        return False
+    with channel_start_lock, account_locks:
+        if channel_to_process.get(channel_id) is not process or not channel_has_consumers(channel_id):
+            return False
+        try:
+            replacement = start_ffmpeg_on(channel_id, alternates)
+        except Exception as e:
+            logging.error(f"Failed to fail over channel {channel_id}: {e}")
+            return False
+        channel_to_process[channel_id] = replacement
+
+    logging.warning(
+        f"Channel {channel_id}: no data from {process.upstream_base}, switched to {replacement.upstream_base}."
+    )
+    if process.poll() is None:
+        process.kill()
+    start_ffmpeg_readers(channel_id, replacement)
+    return True
+
+
+def _start_channel_locked(channel_id):
+    account = find_available_account(ACCOUNTS)
+    if not account:
+        return None, "No available accounts"
+
+    lock_account(account, channel_id)
+    try:
+        # Fastest healthy upstream host first, the others as failover candidates
+        upstreams = [
+            (base_url, f"{base_url}/{account['username']}/{account['password']}/{channel_id}")
+            for base_url in ranked_hosts(account)
+        ]
+        use_relay = STREAM_ENGINE == "relay" and not STREAM_RENDITIONS
+        if use_relay:
+            (upstream_base, input_url), alternates = upstreams[0], upstreams[1:]
+            process = RelaySession(channel_id, input_url, upstream_base, alternates)
+        else:
+            process = start_ffmpeg_on(channel_id, upstreams)
+        channel_to_process[channel_id] = process
+        channel_to_account[channel_id] = account
+        channel_viewers_queues[channel_id] = {}
+
+        if TIMESHIFT_ENABLED:
+            try:
+                channel_timeshift[channel_id] = TimeshiftBuffer(
+                    channel_id, TIMESHIFT_BUFFER_MB * 1024 * 1024, TIMESHIFT_DIR
+                )
+            except Exception as e:
+                logging.error(f"Failed to create timeshift buffer for channel {channel_id}: {e}")
+
+        if use_relay:
+            threading.Thread(
+                target=relay_ts_stream,
+                args=(channel_id, process, channel_viewers_queues, last_buffer_update, release_account_if_inactive),
+                kwargs={"timeshift_buffers": channel_timeshift},
+                daemon=True
+            ).start()
+        else:
+            start_ffmpeg_readers(channel_id, process)
+
+    except Exception as e:
+        logging.error(f"Failed to start channel {channel_id}: {e}")
+        release_account(account, channel_id)
+        return None, "Failed to start stream"
+
+    return process, None
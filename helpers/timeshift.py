@@ -0,0 +1,157 @@
+import os
+import mmap
+import time
+import bisect
+import logging
+import threading
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+FALLBACK_INDEX_INTERVAL = 1.0  # seconds between index points when the stream has no RAI flags
+
+
+class TimeshiftBuffer:
+    """
+    Fixed-size, memory-mapped on-disk ring of MPEG-TS data for one channel.
+
+    Positions are absolute byte offsets since the channel started; only the
+    last `size` bytes are retained. Packets carrying the random-access
+    indicator (keyframes) are indexed with their wall-clock time so viewers
+    can join at an offset or at a given time and still start on a keyframe.
+    """
+
+    def __init__(self, channel_id, size_bytes, directory):
+        self.channel_id = channel_id
+        self.size = max(size_bytes - size_bytes % TS_PACKET_SIZE, TS_PACKET_SIZE)
+        self.path = os.path.join(directory, f"{channel_id}.ts")
+        self.write_pos = 0
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "w+b")
+        self._file.truncate(self.size)
+        self._mm = mmap.mmap(self._file.fileno(), self.size)
+        self._cond = threading.Condition()
+        self._scan_pos = 0           # next absolute offset expected to start a TS packet
+        self._index_times = []       # wall-clock times of indexed packets (sorted)
+        self._index_positions = []   # matching absolute offsets
+        self._saw_rai = False
+        logging.debug(f"Timeshift buffer for channel {channel_id}: {self.size} bytes at {self.path}.")
+
+    # ------------------------------------------------------------------
+    # Writer side (called from the channel's reader thread)
+    # ------------------------------------------------------------------
+    def write(self, data):
+        with self._cond:
+            if self.closed:
+                return
+            n = len(data)
+            if n > self.size:
+                # Only the tail can be retained anyway
+                self.write_pos += n - self.size
+                self._scan_pos = max(self._scan_pos, self.write_pos)
+                data = data[n - self.size:]
+                n = self.size
+
+            start = self.write_pos % self.size
+            first = min(n, self.size - start)
+            self._mm[start:start + first] = data[:first]
+            if first < n:
+                self._mm[0:n - first] = data[first:]
+            self.write_pos += n
+
+            self._index_new_packets()
+            self._trim_index()
+            self._cond.notify_all()
+
+    def _peek(self, pos, length):
+        start = pos % self.size
+        end = start + length
+        if end <= self.size:
+            return self._mm[start:end]
+        return self._mm[start:] + self._mm[:end - self.size]
+
+    def _index_new_packets(self):
+        now = time.time()
+        pos = self._scan_pos
+        while pos + 6 <= self.write_pos:
+            header = self._peek(pos, 6)
+            if header[0] != TS_SYNC_BYTE:
+                pos += 1  # lost sync, slide until we find it again
+                continue
+
+            has_adaptation = header[3] & 0x20
+            is_keyframe = has_adaptation and header[4] > 0 and header[5] & 0x40
+            if is_keyframe:
+                self._saw_rai = True
+                self._add_index_point(now, pos)
+            elif not self._saw_rai and (
+                not self._index_times or now - self._index_times[-1] >= FALLBACK_INDEX_INTERVAL
+            ):
+                self._add_index_point(now, pos)
+            pos += TS_PACKET_SIZE
+        self._scan_pos = pos
+
+    def _add_index_point(self, wall_time, pos):
+        self._index_times.append(wall_time)
+        self._index_positions.append(pos)
+
+    def _trim_index(self):
+        oldest = self.oldest_position()
+        drop = bisect.bisect_left(self._index_positions, oldest)
+        if drop:
+            del self._index_times[:drop]
+            del self._index_positions[:drop]
+
+    # ------------------------------------------------------------------
+    # Reader side
+    # ------------------------------------------------------------------
+    def oldest_position(self):
+        return max(0, self.write_pos - self.size)
+
+    def seek_time(self, wall_time):
+        """Return the position of the last keyframe at or before wall_time (or the oldest one)."""
+        with self._cond:
+            if not self._index_positions:
+                return self.write_pos
+            i = bisect.bisect_right(self._index_times, wall_time) - 1
+            return self._index_positions[max(i, 0)]
+
+    def seek_offset(self, offset_seconds):
+        """Offset is relative to now, e.g. -300 for five minutes ago."""
+        return self.seek_time(time.time() + min(offset_seconds, 0))
+
+    def read(self, pos, max_bytes, timeout=1.0):
+        """
+        Return (data, new_pos). Waits up to `timeout` for new data when the
+        reader is at the live edge. A reader that fell behind the retained
+        window is moved forward to the oldest keyframe still on disk.
+        """
+        with self._cond:
+            if self.closed:
+                return b"", pos
+            if pos >= self.write_pos:
+                self._cond.wait(timeout)
+                if self.closed or pos >= self.write_pos:
+                    return b"", pos
+
+            if pos < self.oldest_position():
+                logging.debug(f"Timeshift reader fell behind on channel {self.channel_id}, skipping ahead.")
+                pos = self._index_positions[0] if self._index_positions else self.oldest_position()
+
+            length = min(max_bytes, self.write_pos - pos)
+            return self._peek(pos, length), pos + length
+
+    def close(self):
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._cond.notify_all()
+            self._mm.close()
+            self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        logging.debug(f"Timeshift buffer for channel {self.channel_id} closed.")
@@ -0,0 +1,151 @@
+import time
+import socket
+import logging
+from threading import Lock
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from config import (
+    ACCOUNTS, UPSTREAM_HOSTS, UPSTREAM_PROBE_INTERVAL, UPSTREAM_PROBE_PATH,
+    UPSTREAM_PROBE_BYTES, UPSTREAM_FAILURE_COOLDOWN
+)
+
+upstream_lock = Lock()
+upstream_stats = {}  # base url -> {"connect", "ttfb", "throughput", "healthy", "checked_at", "failed_at"}
+
+
+def candidate_hosts(account):
+    """Base URLs (no trailing slash) this account can be served from, in configured order."""
+    return [host.format(server=account["server"]).rstrip("/") for host in UPSTREAM_HOSTS]
+
+
+def probe_host(base_url, account, timeout=5):
+    """
+    Measure TCP connect time, time-to-first-byte and throughput of one host.
+    Returns a stats dict; "healthy" is False if any step failed.
+    """
+    parts = urlsplit(base_url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    stats = {"connect": None, "ttfb": None, "throughput": None, "healthy": False, "checked_at": time.time()}
+    try:
+        t0 = time.monotonic()
+        socket.create_connection((parts.hostname, port), timeout=timeout).close()
+        stats["connect"] = time.monotonic() - t0
+
+        probe_url = base_url + UPSTREAM_PROBE_PATH.format(**account)
+        t0 = time.monotonic()
+        with requests.get(probe_url, stream=True, timeout=(timeout, timeout)) as response:
+            response.raise_for_status()
+            received = 0
+            first_byte_at = None
+            for chunk in response.iter_content(chunk_size=16384):
+                if first_byte_at is None:
+                    first_byte_at = time.monotonic()
+                received += len(chunk)
+                if received >= UPSTREAM_PROBE_BYTES or time.monotonic() - first_byte_at > timeout:
+                    break
+        if first_byte_at is None:
+            raise IOError("empty response")
+        stats["ttfb"] = first_byte_at - t0
+        elapsed = max(time.monotonic() - first_byte_at, 1e-3)
+        stats["throughput"] = received / elapsed
+        stats["healthy"] = True
+    except Exception as e:
+        logging.warning(f"Upstream probe failed for {base_url}: {e}")
+    return stats
+
+
+def _score(stats):
+    """Estimated seconds to start and pull UPSTREAM_PROBE_BYTES from a host (lower is better)."""
+    return stats["connect"] + stats["ttfb"] + UPSTREAM_PROBE_BYTES / max(stats["throughput"], 1)
+
+
+def ranked_hosts(account):
+    """
+    Candidate hosts for an account, fastest healthy first. Unprobed hosts keep
+    their configured order after the probed ones; hosts that failed recently
+    go last so they are still tried if nothing else works.
+    """
+    now = time.time()
+    hosts = candidate_hosts(account)
+    with upstream_lock:
+        def sort_key(item):
+            position, host = item
+            stats = upstream_stats.get(host)
+            if stats and now - (stats.get("failed_at") or 0) < UPSTREAM_FAILURE_COOLDOWN:
+                return (2, position)
+            if stats and stats["healthy"]:
+                return (0, _score(stats))
+            if stats is None:
+                return (1, position)
+            return (2, position)
+        return [host for _, host in sorted(enumerate(hosts), key=sort_key)]
+
+
+def is_server_failure(error):
+    """
+    True if a requests error means the host itself is unhealthy (connection
+    error, timeout, broken transfer or 5xx), as opposed to a client-side
+    answer such as 401/404 that another host would give just the same.
+    """
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+
+def check_upstream(url, timeout=5):
+    """
+    Request a stream URL once to find out why it produced no data. Returns
+    True if the host failed (see is_server_failure), False if it answered,
+    e.g. with a 404 for a channel id it does not have.
+    """
+    try:
+        with requests.get(url, stream=True, timeout=(timeout, timeout)) as response:
+            return response.status_code >= 500
+    except requests.RequestException as e:
+        return is_server_failure(e)
+
+
+def mark_upstream_failure(base_url):
+    """Record a connection/server error so the next request fails over to another host."""
+    logging.warning(f"Upstream {base_url} failed; skipping it for {UPSTREAM_FAILURE_COOLDOWN}s.")
+    with upstream_lock:
+        stats = upstream_stats.setdefault(base_url, {
+            "connect": None, "ttfb": None, "throughput": None, "healthy": False, "checked_at": None,
+        })
+        stats["healthy"] = False
+        stats["failed_at"] = time.time()
+
+
+def probe_all():
+    """Probe every distinct candidate host once, concurrently."""
+    targets = {}
+    for account in ACCOUNTS:
+        for host in candidate_hosts(account):
+            targets.setdefault(host, account)
+    if not targets:
+        return
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        results = dict(zip(targets, pool.map(lambda item: probe_host(*item), targets.items())))
+    with upstream_lock:
+        for host, stats in results.items():
+            previous = upstream_stats.get(host, {})
+            # A successful probe clears an earlier failure
+            stats["failed_at"] = None if stats["healthy"] else previous.get("failed_at") or stats["checked_at"]
+            upstream_stats[host] = stats
+    logging.info("Upstream probe: " + ", ".join(
+        f"{host} {'ok' if s['healthy'] else 'down'}"
+        + (f" ({_score(s):.2f}s)" if s["healthy"] else "")
+        for host, s in results.items()
+    ))
+
+
+def run_upstream_prober():
+    while True:
+        try:
+            probe_all()
+        except Exception as e:
+            logging.error(f"Upstream prober error: {e}")
+        time.sleep(UPSTREAM_PROBE_INTERVAL)
@@ -1,3 +1,4 @@
+import datetime
 import re
 
 def clean_text(text):
@@ -12,3 +13,15 @@ def normalize_name(name):
     for term in common_terms:
         name = name.replace(term, "")
     return re.sub(r'\s+', ' ', name)
+
+def parse_wall_clock(value):
+    """Parse a unix timestamp, ISO-8601 or XMLTV ("20240101120000 +0000") time into a unix timestamp."""
+    value = value.strip()
+    if re.fullmatch(r'\d{14}( [+-]\d{4})?', value):
+        fmt = "%Y%m%d%H%M%S %z" if " " in value else "%Y%m%d%H%M%S"
+        return datetime.datetime.strptime(value, fmt).timestamp()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    return datetime.datetime.fromisoformat(value).timestamp()
@@ -1,4 +1,6 @@
 import os
+import re
+import tempfile
 from flask import Blueprint, send_from_directory, Response, request, jsonify
 from config import STATIC_DIR, FILTERED_PLAYLIST_FILE_PATH, EPG_FILE_PATH
 from services.channel_manager import channel_to_process
@@ -7,9 +9,13 @@ import logging
 # <-- ADDED: we will use these to force refresh
 from helpers.scheduler import update_epg_once
 from helpers.downloader import download_m3u
-from helpers.epg_filter import filter_to_allowed_groups, filter_m3u, load_epg_display_names
+from helpers.epg_filter import filter_to_allowed_groups, filter_m3u, resolve_extinf, read_m3u_entries
 from config import ACCOUNTS, PLAYLIST_FILE_PATH, FILTERED_EPG_FILE_PATH, ALLOWED_GROUPS
-from helpers.logo_cache import download_and_process_logo
+from helpers.logo_cache import download_and_process_logo, get_hashed_filename
+from helpers.snapshot import get_epg_display_names, runtime_state, refresh_snapshot
+from helpers.startup import startup_state
+from helpers.epg_diff import changes_since
+from helpers.upstream import upstream_lock, upstream_stats
 
 main_bp = Blueprint('main', __name__)
 
@@ -18,6 +24,28 @@ main_bp = Blueprint('main', __name__)
 def serve_index():
     return send_from_directory(STATIC_DIR, 'index.html')
 
+@main_bp.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness probe: the server answers as soon as it is up, but only
+    returns 200 once background initialization has fully warmed the state.
+    """
+    body = {
+        "status": startup_state["phase"],
+        "snapshot_loaded": startup_state["snapshot_loaded"],
+        "started_at": startup_state["started_at"],
+        "ready_at": startup_state["ready_at"],
+        "channels": len(runtime_state["channels"]),
+        "epg_display_names": len(runtime_state["epg_display_names"]),
+    }
+    with upstream_lock:
+        body["upstreams"] = {host: dict(stats) for host, stats in upstream_stats.items()}
+    if startup_state["error"]:
+        body["error"] = startup_state["error"]
+        body["attempts"] = startup_state["attempts"]
+        body["next_retry_at"] = startup_state["next_retry_at"]
+    return jsonify(body), 200 if startup_state["phase"] == "ready" else 503
+
 @main_bp.route('/filtered.m3u', methods=['GET'])
 def serve_filtered_playlist():
     if not os.path.exists(FILTERED_PLAYLIST_FILE_PATH):
@@ -86,13 +114,34 @@ def serve_static_files(filename):
 def refresh_epg():
     try:
         logging.info("[MANUAL REFRESH] Starting EPG refresh by user request...")
-        update_epg_once()  # use the same function from scheduler.py
-        return jsonify({"status": "EPG refreshed successfully"}), 200
+        delta = update_epg_once()  # use the same function from scheduler.py
+        return jsonify({"status": "EPG refreshed successfully", "changes": delta}), 200
     except Exception as e:
         logging.error(f"[MANUAL REFRESH] EPG refresh failed: {e}")
         return jsonify({"error": "Failed to refresh EPG"}), 500
 
 
+# -------------------------------------------------------------------------
+# NEW: Incremental EPG changes since a given guide version
+# -------------------------------------------------------------------------
+@main_bp.route('/epg/changes', methods=['GET'])
+def epg_changes():
+    """
+    Return the channel/programme deltas after ?since=<version>. Clients keep the
+    last version they applied; 410 means the history is gone and they should
+    reload the full guide.
+    """
+    try:
+        since = int(request.args.get("since", 0))
+    except ValueError:
+        return jsonify({"error": "since must be an integer version"}), 400
+
+    version, deltas = changes_since(since)
+    if deltas is None:
+        return jsonify({"version": version, "full_reload": True}), 410
+    return jsonify({"version": version, "since": since, "deltas": deltas}), 200
+
+
 # -------------------------------------------------------------------------
 # NEW: Manually refresh channels (M3U)
 # -------------------------------------------------------------------------
@@ -113,11 +162,12 @@ def refresh_m3u():
             logging.warning("[MANUAL REFRESH] Filtered EPG file not found. EPG IDs might be missing.")
             epg_display_name_to_id = {}
         else:
-            epg_display_name_to_id = load_epg_display_names(FILTERED_EPG_FILE_PATH)
+            epg_display_name_to_id = get_epg_display_names()
 
         if not os.path.exists(FILTERED_PLAYLIST_FILE_PATH):
             logging.info("[MANUAL REFRESH] Creating fresh filtered.m3u because none was found.")
             filter_m3u(PLAYLIST_FILE_PATH, FILTERED_PLAYLIST_FILE_PATH, epg_display_name_to_id, ALLOWED_GROUPS)
+            refresh_snapshot()
 
         return jsonify({"status": "M3U refreshed successfully"}), 200
 
@@ -125,63 +175,96 @@ def refresh_m3u():
         logging.error(f"[MANUAL REFRESH] M3U refresh failed: {e}")
         return jsonify({"error": "Failed to refresh M3U"}), 500
 
+def _m3u_attr(line, name):
+    match = re.search(rf'{name}="([^"]*)"', line)
+    return match.group(1) if match else ""
+
+
+def _entry_unchanged(posted, resolved):
+    """
+    True if `resolved` (a line of the current filtered.m3u) is what saving
+    `posted` would produce, so its cached logo and tvg-ID can be reused.
+    """
+    posted_name = _m3u_attr(posted, "tvg-name")
+    if posted_name.startswith("USA "):
+        posted_name = posted_name.replace("USA ", "", 1)
+    if posted_name != _m3u_attr(resolved, "tvg-name"):
+        return False
+    if _m3u_attr(posted, "group-title") != _m3u_attr(resolved, "group-title"):
+        return False
+    posted_id = _m3u_attr(posted, "tvg-ID")
+    if posted_id and posted_id != _m3u_attr(resolved, "tvg-ID"):
+        return False  # the user edited the tvg-ID
+    posted_logo, resolved_logo = _m3u_attr(posted, "tvg-logo"), _m3u_attr(resolved, "tvg-logo")
+    return posted_logo == resolved_logo or (
+        posted_logo.startswith("http") and resolved_logo.endswith(f"/cache/{get_hashed_filename(posted_logo)}")
+    )
+
+
+def _cache_logo(line):
+    """Replace the tvg-logo of an #EXTINF line with our processed, locally cached copy."""
+    tvg_logo_match = re.search(r'tvg-logo="([^"]+)"', line)
+    if tvg_logo_match:
+        original_logo_url = tvg_logo_match.group(1)
+        # Skip logos that already point at our own cache; any other URL is fetched
+        if original_logo_url.startswith("http") and not original_logo_url.startswith(f"http://{request.host}/cache/"):
+            new_filename = download_and_process_logo(original_logo_url)
+            if new_filename:
+                new_logo_url = f"http://{request.host}/cache/{new_filename}"
+                line = line.replace(original_logo_url, new_logo_url)
+    return line
+
+
 @main_bp.route('/m3u/save_filtered_advanced', methods=['POST'])
 def save_filtered_advanced():
     """
-    Receives a user-edited M3U,
-    runs the fuzzy matching logic to assign tvg-ID,
-    and then writes final output to filtered.m3u.
+    Receives a user-edited M3U and writes it to filtered.m3u.
+    Entries already in filtered.m3u (same URL, unedited) keep their resolved
+    logo and tvg-ID; only new or edited entries get logo caching and fuzzy
+    matching. The file is replaced atomically.
     """
-    from helpers.epg_filter import filter_m3u, load_epg_display_names
-    from helpers.logo_cache import download_and_process_logo
-    from config import FILTERED_PLAYLIST_FILE_PATH, FILTERED_EPG_FILE_PATH
-    import tempfile, re
-
     try:
-        # 1) Write user’s posted M3U to a temp file
         raw_content = request.data.decode("utf-8")
-        with tempfile.NamedTemporaryFile(mode="w", delete=False) as tmp:
-            tmp.write(raw_content)
-            tmp.flush()
-            temp_path = tmp.name
-
-        # 2) Load EPG
-        epg_display_name_to_id = load_epg_display_names(FILTERED_EPG_FILE_PATH)
-
-        # 3) We'll do two passes:
-        #    (a) We'll read the lines from temp_path,
-        #    (b) For each #EXTINF line, we’ll replace the original tvg-logo with our cached version,
-        #    (c) Then write them to the same temp file or a second temp file,
-        #    (d) Pass that final to `filter_m3u`.
+        posted_entries = read_m3u_entries(raw_content)
+
+        # 1) Index the current filtered.m3u by channel URL
+        current = {}
+        if os.path.exists(FILTERED_PLAYLIST_FILE_PATH):
+            with open(FILTERED_PLAYLIST_FILE_PATH, "r", encoding="utf-8") as f:
+                current = {url.strip(): extinf for extinf, url in read_m3u_entries(f.read())}
+
+        # 2) Reuse unchanged entries, process the rest
+        epg_display_name_to_id = None
         final_lines = []
-        with open(temp_path, "r", encoding="utf-8") as f:
-            for line in f:
-                # check #EXTINF lines for tvg-logo
-                if line.startswith("#EXTINF"):
-                    tvg_logo_match = re.search(r'tvg-logo="([^"]+)"', line)
-                    if tvg_logo_match:
-                        original_logo_url = tvg_logo_match.group(1)
-                        if original_logo_url.startswith("http"):
-                            new_filename = download_and_process_logo(original_logo_url)
-                            if new_filename:
-                                new_logo_url = f"http://{request.host}/cache/{new_filename}"
-                                line = line.replace(original_logo_url, new_logo_url)
-                final_lines.append(line)
-
-        # Write that updated M3U back to temp_path 
-        # (or use a second NamedTemporaryFile if you prefer)
-        with open(temp_path, "w", encoding="utf-8") as f:
-            f.writelines(final_lines)
-
-        # 4) Fuzzy match & inject tvg-ID into the final filtered.m3u
-        filter_m3u(
-            input_path=temp_path,
-            output_path=FILTERED_PLAYLIST_FILE_PATH,
-            epg_display_name_to_id=epg_display_name_to_id,
-            allowed_groups=None  # or some list
+        reused = 0
+        for extinf, url in posted_entries:
+            existing = current.get(url.strip())
+            if existing is not None and _entry_unchanged(extinf, existing):
+                final_lines += [existing, url]
+                reused += 1
+                continue
+            if epg_display_name_to_id is None:
+                epg_display_name_to_id = get_epg_display_names()
+            final_lines += [resolve_extinf(_cache_logo(extinf), epg_display_name_to_id), url]
+
+        # 3) Atomic write next to the target so readers never see a partial file
+        # (a unique temp file per save, so concurrent saves cannot clobber each other's)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(FILTERED_PLAYLIST_FILE_PATH), suffix=".m3u.tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as out_file:
+                out_file.write("\n".join(final_lines))
+            os.chmod(tmp_path, 0o644)  # mkstemp creates it 0600
+            os.replace(tmp_path, FILTERED_PLAYLIST_FILE_PATH)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        refresh_snapshot()
+
+        logging.info(
+            f"Filtered playlist saved & tvg-ID assigned: {len(posted_entries)} entries, "
+            f"{reused} reused, {len(posted_entries) - reused} processed."
         )
-
-        logging.info("Filtered playlist saved & tvg-ID assigned.")
         return jsonify({"message": "Filtered playlist saved with fuzzy matching"}), 200
 
     except Exception as e:
@@ -0,0 +1,44 @@
+import logging
+from flask import Blueprint, request, jsonify
+
+from helpers.utils import parse_wall_clock
+from services.recorder import recordings, recordings_lock, schedule_recording, cancel_recording
+
+recordings_bp = Blueprint('recordings', __name__)
+
+
+@recordings_bp.route('/recordings', methods=['GET'])
+def list_recordings():
+    with recordings_lock:
+        return jsonify(sorted(recordings.values(), key=lambda rec: rec["start"])), 200
+
+
+@recordings_bp.route('/recordings', methods=['POST'])
+def add_recording():
+    """
+    Schedule a recording from the filtered guide.
+    Body: {"channel": "<EPG channel id>", "start": "<programme start, e.g. 20240101200000 +0000>"}
+    """
+    payload = request.get_json(silent=True) or {}
+    if not payload.get("channel") or not payload.get("start"):
+        return jsonify({"error": "channel and start are required"}), 400
+    try:
+        parse_wall_clock(str(payload["start"]))
+    except ValueError:
+        return jsonify({"error": "start must be an XMLTV, ISO-8601 or unix time"}), 400
+    try:
+        rec, created = schedule_recording(payload["channel"], str(payload["start"]))
+        return jsonify(rec), 201 if created else 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        logging.error(f"Error scheduling recording: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@recordings_bp.route('/recordings/<recording_id>', methods=['DELETE'])
+def delete_recording(recording_id):
+    rec = cancel_recording(recording_id)
+    if not rec:
+        return jsonify({"error": "Recording not found"}), 404
+    return jsonify(rec), 200
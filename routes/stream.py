@@ -1,53 +1,87 @@
-import threading
+import logging
 import uuid
 import queue
 from flask import Blueprint, request, Response
 
-from config import ACCOUNTS
-from services.account_management import find_available_account, lock_account, release_account
+from config import TIMESHIFT_ENABLED, STREAM_RENDITIONS
+from services.account_management import account_locks
+from services.admission import admit_viewer, release_reservation, refund_start_token, reject
 from services.channel_manager import (
     channel_to_process,
-    channel_to_account,
     channel_viewers_queues,
-    last_buffer_update,
-    release_account_if_inactive,
-    generate_viewer
+    channel_timeshift,
+    channel_timeshift_viewers,
+    viewer_renditions,
+    generate_viewer,
+    generate_timeshift_viewer
 )
-from helpers.streaming import start_ffmpeg_stream, fetch_from_ffmpeg
+from helpers.streaming import start_channel
+from helpers.utils import parse_wall_clock
 
 stream_bp = Blueprint('stream', __name__)
 
 @stream_bp.route('/stream/<channel_id>', methods=['GET'])
-def stream_channel(channel_id):
-    if channel_id in channel_to_process:
-        pass  # Already streaming, do nothing special
-    else:
-        account = find_available_account(ACCOUNTS)
-        if not account:
-            return "No available accounts", 503
-
-        lock_account(account, channel_id)
+@stream_bp.route('/stream/<channel_id>/<rendition>', methods=['GET'])
+def stream_channel(channel_id, rendition=None):
+    # Optional rendition ladder: all renditions come from one FFmpeg decode and one account
+    rendition_names = [r["name"] for r in STREAM_RENDITIONS]
+    if rendition is not None and rendition not in rendition_names:
+        return "Unknown rendition", 404
+    if rendition_names and rendition is None:
+        rendition = rendition_names[0]
+
+    # Optional timeshift: ?offset=-300 (seconds behind live) or ?at=<unix|ISO|XMLTV time>
+    offset = request.args.get("offset")
+    at = request.args.get("at")
+    join_time = None
+    if offset is not None or at is not None:
         try:
-            input_url = f"http://{account['server']}.d4ktv.info:8080/{account['username']}/{account['password']}/{channel_id}"
-            process = start_ffmpeg_stream(channel_id, input_url)
-            channel_to_process[channel_id] = process
-            channel_to_account[channel_id] = account
-            channel_viewers_queues[channel_id] = {}
-
-            threading.Thread(
-                target=fetch_from_ffmpeg,
-                args=(channel_id, process, channel_viewers_queues, last_buffer_update, release_account_if_inactive),
-                daemon=True
-            ).start()
-
-        except Exception as e:
-            release_account(account, channel_id)
-            return "Failed to start stream", 503
-
-    viewer_id = str(uuid.uuid4())
-    q = channel_viewers_queues[channel_id].setdefault(viewer_id, queue.Queue(maxsize=100))
-
-    return Response(
-        generate_viewer(channel_id, viewer_id),
-        content_type="video/mp2t"
-    )
+            join_time = parse_wall_clock(at) if at is not None else float(offset)
+        except ValueError:
+            return "Invalid offset or at parameter", 400
+        if not TIMESHIFT_ENABLED:
+            logging.debug(f"Timeshift requested for channel {channel_id} but it is disabled; serving live.")
+            join_time = None
+
+    # Admission control: per-channel viewer cap, egress budget, channel start rate
+    def count_viewers():
+        channel_viewers = len(channel_viewers_queues.get(channel_id, {})) + len(channel_timeshift_viewers.get(channel_id, ()))
+        total_viewers = (
+            sum(len(v) for v in list(channel_viewers_queues.values()))
+            + sum(len(v) for v in list(channel_timeshift_viewers.values()))
+        )
+        return channel_viewers, total_viewers
+
+    starts_channel = channel_id not in channel_to_process
+    reason, retry_after = admit_viewer(channel_id, count_viewers, starts_channel)
+    if reason:
+        return reject(reason, retry_after)
+
+    # The admitted slot stays reserved until the viewer is registered below
+    try:
+        _, error = start_channel(channel_id)
+        if error:
+            if starts_channel:
+                refund_start_token()
+            return error, 503
+
+        viewer_id = str(uuid.uuid4())
+
+        # Timeshift only covers the default rendition
+        with account_locks:
+            if channel_id not in channel_to_process:
+                return "Stream ended", 503
+            buffer = channel_timeshift.get(channel_id)
+            if join_time is not None and buffer and rendition in (None, *rendition_names[:1]):
+                position = buffer.seek_time(join_time) if at is not None else buffer.seek_offset(join_time)
+                channel_timeshift_viewers.setdefault(channel_id, set()).add(viewer_id)
+                viewer = generate_timeshift_viewer(channel_id, viewer_id, buffer, position)
+            else:
+                if rendition is not None:
+                    viewer_renditions[viewer_id] = rendition
+                channel_viewers_queues[channel_id][viewer_id] = queue.Queue(maxsize=100)
+                viewer = generate_viewer(channel_id, viewer_id)
+    finally:
+        release_reservation(channel_id)
+
+    return Response(viewer, content_type="video/mp2t")
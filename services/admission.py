@@ -0,0 +1,125 @@
+import logging
+import math
+import time
+from threading import Lock
+
+from config import MAX_VIEWERS_PER_CHANNEL, EGRESS_BUDGET_MBPS, CHANNEL_STARTS_PER_MINUTE
+
+admission_lock = Lock()
+
+
+class RateMeter:
+    """Bytes per second over a short sliding window of one-second buckets."""
+
+    def __init__(self, window=5):
+        self.window = window
+        self.buckets = {}  # int(second) -> bytes
+
+    def add(self, nbytes, now=None):
+        second = int(now or time.monotonic())
+        self.buckets[second] = self.buckets.get(second, 0) + nbytes
+        if len(self.buckets) > self.window + 1:
+            for key in [k for k in self.buckets if k <= second - self.window]:
+                del self.buckets[key]
+
+    def rate(self, now=None):
+        second = int(now or time.monotonic())
+        # Only count whole seconds so a fresh bucket does not skew the average
+        total = sum(v for k, v in self.buckets.items() if second - self.window <= k < second)
+        return total / self.window
+
+
+egress_meter = RateMeter()
+channel_egress_meters = {}  # channel_id -> RateMeter
+channel_reservations = {}   # channel_id -> viewers admitted but not registered yet
+start_tokens = float(CHANNEL_STARTS_PER_MINUTE)
+start_tokens_updated = time.monotonic()
+
+
+def record_egress(channel_id, nbytes):
+    """Account bytes handed to a viewer connection."""
+    with admission_lock:
+        egress_meter.add(nbytes)
+        channel_egress_meters.setdefault(channel_id, RateMeter()).add(nbytes)
+
+
+def forget_channel(channel_id):
+    with admission_lock:
+        channel_egress_meters.pop(channel_id, None)
+
+
+def _refill_start_tokens(now):
+    global start_tokens, start_tokens_updated
+    per_second = CHANNEL_STARTS_PER_MINUTE / 60.0
+    start_tokens = min(float(CHANNEL_STARTS_PER_MINUTE), start_tokens + (now - start_tokens_updated) * per_second)
+    start_tokens_updated = now
+
+
+def admit_viewer(channel_id, count_viewers, starts_channel):
+    """
+    Decide whether a new viewer may join. Returns (None, None) when admitted,
+    otherwise (reason, retry_after_seconds). `count_viewers()` returns the
+    (channel, total) viewer counts and is called under the admission lock.
+    An admitted viewer holds a reserved slot until release_reservation() is
+    called, once it is registered or failed to start, so a burst of requests
+    cannot all pass the viewer cap. A channel start token is only consumed
+    once every other check has passed.
+    """
+    global start_tokens
+    with admission_lock:
+        channel_viewers, total_viewers = count_viewers()
+        channel_viewers += channel_reservations.get(channel_id, 0)
+        total_viewers += sum(channel_reservations.values())
+
+        if MAX_VIEWERS_PER_CHANNEL and channel_viewers >= MAX_VIEWERS_PER_CHANNEL:
+            return f"Channel {channel_id} is at its viewer limit", 30
+
+        if EGRESS_BUDGET_MBPS:
+            budget = EGRESS_BUDGET_MBPS * 1_000_000 / 8
+            current = egress_meter.rate()
+            # Estimate what one more viewer costs from what this channel (or the average viewer) uses now
+            channel_meter = channel_egress_meters.get(channel_id)
+            if channel_meter and channel_viewers:
+                estimate = channel_meter.rate() / channel_viewers
+            elif total_viewers:
+                estimate = current / total_viewers
+            else:
+                estimate = 0
+            if current + estimate > budget:
+                return "Egress bandwidth budget exhausted", 10
+
+        if starts_channel and CHANNEL_STARTS_PER_MINUTE:
+            now = time.monotonic()
+            _refill_start_tokens(now)
+            if start_tokens < 1:
+                retry_after = math.ceil((1 - start_tokens) * 60.0 / CHANNEL_STARTS_PER_MINUTE)
+                return "Too many channel starts, slow down", retry_after
+            start_tokens -= 1
+
+        channel_reservations[channel_id] = channel_reservations.get(channel_id, 0) + 1
+
+    return None, None
+
+
+def release_reservation(channel_id):
+    """Give back the slot reserved by admit_viewer()."""
+    with admission_lock:
+        remaining = channel_reservations.get(channel_id, 0) - 1
+        if remaining > 0:
+            channel_reservations[channel_id] = remaining
+        else:
+            channel_reservations.pop(channel_id, None)
+
+
+def refund_start_token():
+    """Return the start token of a channel start that did not happen (e.g. no free account)."""
+    global start_tokens
+    if not CHANNEL_STARTS_PER_MINUTE:
+        return
+    with admission_lock:
+        start_tokens = min(float(CHANNEL_STARTS_PER_MINUTE), start_tokens + 1)
+
+
+def reject(reason, retry_after):
+    logging.warning(f"Admission rejected: {reason} (retry after {retry_after}s).")
+    return reason, 503, {"Retry-After": str(retry_after)}
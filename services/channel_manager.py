@@ -2,29 +2,84 @@ import logging
 import datetime
 import queue
 from services.account_management import release_account, account_locks
+from services.admission import record_egress, forget_channel
 
-channel_to_process = {}        # channel_id -> FFmpeg Popen
+VIEWER_BATCH_BYTES = 256 * 1024  # coalesce queued chunks into writes of up to this size
+
+channel_to_process = {}        # channel_id -> FFmpeg Popen (or RelaySession)
 channel_to_account = {}        # channel_id -> account dict
 channel_viewers_queues = {}    # channel_id -> {viewer_id -> Queue}
 last_buffer_update = {}        # channel_id -> datetime of last buffer
+channel_timeshift = {}         # channel_id -> TimeshiftBuffer
+channel_timeshift_viewers = {} # channel_id -> set of viewer_ids reading from the timeshift buffer
+viewer_renditions = {}         # viewer_id -> rendition name (only when a rendition ladder is configured)
+channel_sinks = {}             # channel_id -> {sink_id -> internal consumer with write(data)} (e.g. recordings)
 
-def release_account_if_inactive(channel_id):
+def release_account_if_inactive(channel_id, process):
     """
-    Release FFmpeg process and associated resources for an inactive channel.
+    Release the FFmpeg process and associated resources of a channel whose reader
+    ended. Only `process` (the session that reader served) is torn down: if the
+    channel was already stopped and started again, the newer session is left alone.
     """
     logging.debug(f"Releasing channel {channel_id} if inactive.")
-    # Stop the FFmpeg process
+    with account_locks:
+        if channel_to_process.get(channel_id) is not process:
+            logging.debug(f"Channel {channel_id} was already stopped or restarted; nothing to release.")
+            return
+        stop_channel(channel_id)
 
-    # Release the associated account
+def channel_has_consumers(channel_id):
+    return bool(
+        channel_viewers_queues.get(channel_id)
+        or channel_timeshift_viewers.get(channel_id)
+        or channel_sinks.get(channel_id)
+    )
+
+def stop_channel(channel_id):
+    """Kill the channel's upstream session and free its account. Caller holds account_locks."""
+    logging.debug(f"No more consumers left for channel {channel_id}. Stopping FFmpeg.")
+    proc = channel_to_process.pop(channel_id, None)
+    if proc and proc.poll() is None:
+        proc.kill()
     acct = channel_to_account.pop(channel_id, None)
     if acct:
         release_account(acct, channel_id)
+    # Clean up channel data
+    channel_viewers_queues.pop(channel_id, None)
+    last_buffer_update.pop(channel_id, None)
+    channel_timeshift_viewers.pop(channel_id, None)
+    buffer = channel_timeshift.pop(channel_id, None)
+    if buffer:
+        buffer.close()
+    forget_channel(channel_id)
+
+def detach_viewer(channel_id, viewer_id):
+    """
+    Remove a live or timeshift viewer and, if no consumers remain, tear down the channel.
+    """
+    logging.debug(f"Viewer {viewer_id} disconnected from channel {channel_id}. Cleaning up.")
+    with account_locks:
+        viewer_renditions.pop(viewer_id, None)
+        if channel_id in channel_viewers_queues:
+            channel_viewers_queues[channel_id].pop(viewer_id, None)
+            channel_timeshift_viewers.get(channel_id, set()).discard(viewer_id)
+            if not channel_has_consumers(channel_id):
+                stop_channel(channel_id)
 
-    # Cleanup
-    if channel_id in channel_viewers_queues:
-        del channel_viewers_queues[channel_id]
-    if channel_id in last_buffer_update:
-        del last_buffer_update[channel_id]
+def attach_sink(channel_id, sink_id, sink):
+    """Register an internal consumer; it is fed on the channel's reader thread."""
+    with account_locks:
+        channel_sinks.setdefault(channel_id, {})[sink_id] = sink
+
+def detach_sink(channel_id, sink_id):
+    """Remove an internal consumer and, if no consumers remain, tear down the channel."""
+    with account_locks:
+        sinks = channel_sinks.get(channel_id, {})
+        sinks.pop(sink_id, None)
+        if not sinks:
+            channel_sinks.pop(channel_id, None)
+        if channel_id in channel_to_process and not channel_has_consumers(channel_id):
+            stop_channel(channel_id)
 
 def generate_viewer(channel_id, viewer_id):
     """
@@ -41,26 +96,42 @@ def generate_viewer(channel_id, viewer_id):
         while True:
             try:
                 data = q.get(timeout=10)  # Wait for data
-                yield data
+                # Chunks are shared memoryviews; the WSGI server needs bytes, so
+                # take everything already queued and make that one copy/write
+                chunks = [data]
+                size = len(data)
+                while size < VIEWER_BATCH_BYTES:
+                    try:
+                        data = q.get_nowait()
+                    except queue.Empty:
+                        break
+                    chunks.append(data)
+                    size += len(data)
+                yield b"".join(chunks)
+                record_egress(channel_id, size)
             except queue.Empty:
                 logging.warning(f"Buffer empty for channel {channel_id}, viewer {viewer_id}.")
                 break
     finally:
         # Clean up when the viewer disconnects
-        logging.debug(f"Viewer {viewer_id} disconnected from channel {channel_id}. Cleaning up.")
-        with account_locks:
-            if channel_id in channel_viewers_queues:
-                if viewer_id in channel_viewers_queues[channel_id]:
-                    del channel_viewers_queues[channel_id][viewer_id]
-                # If no viewers remain, clean up the channel
-                if not channel_viewers_queues[channel_id]:
-                    logging.debug(f"No more viewers left for channel {channel_id}. Stopping FFmpeg.")
-                    proc = channel_to_process.pop(channel_id, None)
-                    if proc and proc.poll() is None:
-                        proc.kill()
-                    acct = channel_to_account.pop(channel_id, None)
-                    if acct:
-                        release_account(acct, channel_id)
-                    # Clean up channel data
-                    channel_viewers_queues.pop(channel_id, None)
-                    last_buffer_update.pop(channel_id, None)
+        detach_viewer(channel_id, viewer_id)
+
+def generate_timeshift_viewer(channel_id, viewer_id, buffer, position):
+    """
+    Yield data for a viewer that joined behind the live edge, reading from the
+    channel's on-disk timeshift buffer. A paused client simply stops consuming;
+    playback resumes from the same position as long as it is still retained.
+    """
+    try:
+        idle_since = datetime.datetime.now()
+        while not buffer.closed:
+            data, position = buffer.read(position, 65536, timeout=1)
+            if data:
+                idle_since = datetime.datetime.now()
+                yield data
+                record_egress(channel_id, len(data))
+            elif datetime.datetime.now() - idle_since > datetime.timedelta(seconds=10):
+                logging.warning(f"Timeshift buffer idle for channel {channel_id}, viewer {viewer_id}.")
+                break
+    finally:
+        detach_viewer(channel_id, viewer_id)
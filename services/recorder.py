@@ -0,0 +1,189 @@
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import datetime
+import xml.etree.ElementTree as ET
+from threading import Lock
+
+from config import (
+    FILTERED_EPG_FILE_PATH, RECORDINGS_DIR, RECORDINGS_FILE_PATH,
+    RECORDING_PADDING_SECONDS, RECORDING_BUFFER_MB
+)
+from helpers.snapshot import get_channel_catalog
+from helpers.streaming import start_channel
+from helpers.utils import parse_wall_clock
+from services.channel_manager import channel_to_process, attach_sink, detach_sink
+
+recordings_lock = Lock()
+recordings = {}      # recording_id -> recording dict (persisted)
+active_sinks = {}    # recording_id -> RecordingSink
+
+
+class RecordingSink:
+    """
+    Internal consumer of a channel: the channel's reader thread calls write()
+    with the same chunks the viewers get, and they go to disk through a large
+    write buffer. No thread, queue or HTTP connection of its own.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.bytes_written = 0
+        self._lock = Lock()
+        self._file = open(path, "ab", buffering=RECORDING_BUFFER_MB * 1024 * 1024)
+
+    def write(self, data):
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(data)
+                self.bytes_written += len(data)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _save_recordings():
+    os.makedirs(RECORDINGS_DIR, exist_ok=True)
+    tmp_path = f"{RECORDINGS_FILE_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(list(recordings.values()), file, indent=2)
+    os.replace(tmp_path, RECORDINGS_FILE_PATH)
+
+
+def load_recordings():
+    """Reload the schedule; recordings interrupted by a restart are resumed if still running."""
+    if not os.path.exists(RECORDINGS_FILE_PATH):
+        return
+    try:
+        with open(RECORDINGS_FILE_PATH, "r", encoding="utf-8") as file:
+            with recordings_lock:
+                for rec in json.load(file):
+                    if rec["status"] == "recording":
+                        rec["status"] = "scheduled"
+                    recordings[rec["id"]] = rec
+    except Exception as e:
+        logging.error(f"Failed to load recordings: {e}")
+
+
+def find_programme(epg_channel, start):
+    """Return (title, start_ts, stop_ts) of the programme on epg_channel starting at `start`."""
+    start_ts = parse_wall_clock(start)
+    for _, elem in ET.iterparse(FILTERED_EPG_FILE_PATH):
+        if elem.tag == "programme":
+            if elem.get("channel") == epg_channel and parse_wall_clock(elem.get("start")) == start_ts:
+                title = elem.findtext("title") or "Untitled"
+                return title, start_ts, parse_wall_clock(elem.get("stop"))
+            elem.clear()
+    return None
+
+
+def schedule_recording(epg_channel, start):
+    """
+    Schedule the guide programme on EPG channel `epg_channel` that starts at
+    `start` (XMLTV, ISO or unix time). Returns (recording, created): if the
+    programme is already scheduled or being recorded, that recording is
+    returned instead of a second one writing to the same file.
+    Raises ValueError if the programme cannot be resolved.
+    """
+    stream_ids = [c["channel_id"] for c in get_channel_catalog() if c["tvg_id"] == epg_channel]
+    if not stream_ids:
+        raise ValueError(f"No channel in filtered.m3u has tvg-ID {epg_channel}")
+
+    programme = find_programme(epg_channel, start)
+    if not programme:
+        raise ValueError(f"No programme on {epg_channel} starts at {start}")
+    title, start_ts, stop_ts = programme
+
+    recording_id = str(uuid.uuid4())
+    stamp = datetime.datetime.fromtimestamp(start_ts).strftime("%Y%m%d-%H%M")
+    safe_title = re.sub(r'[^A-Za-z0-9]+', '_', title).strip("_")
+    rec = {
+        "id": recording_id,
+        "epg_channel": epg_channel,
+        "channel_id": stream_ids[0],
+        "title": title,
+        "start": start_ts,
+        "stop": stop_ts,
+        "status": "scheduled",
+        "path": os.path.join(RECORDINGS_DIR, f"{safe_title}-{epg_channel}-{stamp}.ts"),
+        "bytes": 0,
+    }
+    with recordings_lock:
+        for existing in recordings.values():
+            if (
+                existing["epg_channel"] == epg_channel and existing["start"] == start_ts
+                and existing["status"] in ("scheduled", "recording")
+            ):
+                logging.info(f"'{title}' on {epg_channel} is already scheduled ({existing['id']}).")
+                return existing, False
+        recordings[recording_id] = rec
+        _save_recordings()
+    logging.info(f"Scheduled recording of '{title}' on {epg_channel} ({recording_id}).")
+    return rec, True
+
+
+def cancel_recording(recording_id):
+    """Stop (if running) and forget a recording. The file on disk is kept."""
+    with recordings_lock:
+        rec = recordings.pop(recording_id, None)
+        if rec:
+            _stop(rec, "cancelled")
+            _save_recordings()
+    return rec
+
+
+def _start(rec):
+    _, error = start_channel(rec["channel_id"])
+    if error:
+        logging.warning(f"Recording {rec['id']} could not start channel {rec['channel_id']}: {error}")
+        return
+    if rec["id"] not in active_sinks:
+        os.makedirs(RECORDINGS_DIR, exist_ok=True)
+        sink = RecordingSink(rec["path"])
+        active_sinks[rec["id"]] = sink
+        attach_sink(rec["channel_id"], rec["id"], sink)
+        logging.info(f"Recording '{rec['title']}' to {rec['path']}.")
+    rec["status"] = "recording"
+
+
+def _stop(rec, status):
+    sink = active_sinks.pop(rec["id"], None)
+    if sink:
+        detach_sink(rec["channel_id"], rec["id"])
+        sink.close()
+        rec["bytes"] = sink.bytes_written
+        logging.info(f"Recording '{rec['title']}' {status} ({sink.bytes_written} bytes).")
+    rec["status"] = status
+
+
+def run_recorder(poll_seconds=5):
+    """One loop for all recordings: start due ones, stop finished ones, restart dropped channels."""
+    load_recordings()
+    while True:
+        try:
+            now = time.time()
+            with recordings_lock:
+                changed = False
+                for rec in recordings.values():
+                    if rec["status"] not in ("scheduled", "recording"):
+                        continue
+                    if now >= rec["stop"] + RECORDING_PADDING_SECONDS:
+                        _stop(rec, "completed" if rec["id"] in active_sinks else "missed")
+                        changed = True
+                    elif now >= rec["start"] - RECORDING_PADDING_SECONDS:
+                        was = rec["status"]
+                        # Also re-starts the channel if the upstream dropped mid-recording
+                        if was != "recording" or rec["channel_id"] not in channel_to_process:
+                            _start(rec)
+                            changed = changed or rec["status"] != was
+                    if rec["id"] in active_sinks:
+                        rec["bytes"] = active_sinks[rec["id"]].bytes_written
+                if changed:
+                    _save_recordings()
+        except Exception as e:
+            logging.error(f"Recorder loop error: {e}")
+        time.sleep(poll_seconds)
@@ -0,0 +1,184 @@
+import os
+import time
+import socket
+import tempfile
+import threading
+import unittest
+import http.server
+import socketserver
+from unittest import mock
+
+import requests
+
+from helpers import upstream, downloader
+
+ACCOUNT = {"server": "x", "username": "u", "password": "p"}
+
+
+def stand_in_server(status=200, delay=0.0, body=b"#EXTM3U\n" * 4096):
+    """Start a local HTTP server answering every GET with `status`; returns (base_url, server)."""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(status)
+            self.end_headers()
+            if status == 200:
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}", server
+
+
+def closed_port_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def healthy(connect, ttfb, throughput):
+    return {"connect": connect, "ttfb": ttfb, "throughput": throughput, "healthy": True,
+            "checked_at": time.time(), "failed_at": None}
+
+
+class UpstreamTestCase(unittest.TestCase):
+    def setUp(self):
+        upstream.upstream_stats.clear()
+        self.addCleanup(upstream.upstream_stats.clear)
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.workdir = workdir.name
+
+    def use_hosts(self, hosts):
+        patcher = mock.patch.object(upstream, "UPSTREAM_HOSTS", hosts)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class RankingTests(UpstreamTestCase):
+    def test_score_prefers_lower_latency_and_higher_throughput(self):
+        fast = healthy(0.01, 0.05, 10_000_000)
+        slow_start = healthy(0.5, 0.5, 10_000_000)
+        slow_transfer = healthy(0.01, 0.05, 10_000)
+        self.assertLess(upstream._score(fast), upstream._score(slow_start))
+        self.assertLess(upstream._score(fast), upstream._score(slow_transfer))
+
+    def test_ranked_hosts_orders_healthy_then_unprobed_then_failed(self):
+        hosts = ["http://a", "http://b", "http://c", "http://d", "http://e"]
+        self.use_hosts(hosts)
+        upstream.upstream_stats.update({
+            "http://a": {**healthy(None, None, None), "healthy": False, "failed_at": time.time()},
+            "http://c": healthy(0.3, 0.3, 1_000_000),
+            "http://e": healthy(0.01, 0.01, 50_000_000),
+        })
+        # Healthy by score, then unprobed in configured order, then the benched host
+        self.assertEqual(upstream.ranked_hosts(ACCOUNT), ["http://e", "http://c", "http://b", "http://d", "http://a"])
+
+    def test_candidate_hosts_fill_in_the_account_server(self):
+        self.use_hosts(["http://{server}.example:8080/"])
+        self.assertEqual(upstream.candidate_hosts(ACCOUNT), ["http://x.example:8080"])
+
+
+class CooldownTests(UpstreamTestCase):
+    def test_failure_benches_host_until_a_probe_succeeds(self):
+        self.use_hosts(["http://a", "http://b"])
+        upstream.upstream_stats["http://a"] = healthy(0.01, 0.01, 50_000_000)
+        upstream.upstream_stats["http://b"] = healthy(0.2, 0.2, 1_000_000)
+        self.assertEqual(upstream.ranked_hosts(ACCOUNT)[0], "http://a")
+
+        upstream.mark_upstream_failure("http://a")
+        self.assertEqual(upstream.ranked_hosts(ACCOUNT), ["http://b", "http://a"])
+
+        # Once the cooldown is over it is still unhealthy until a probe succeeds
+        upstream.upstream_stats["http://a"]["failed_at"] -= upstream.UPSTREAM_FAILURE_COOLDOWN + 1
+        self.assertEqual(upstream.ranked_hosts(ACCOUNT), ["http://b", "http://a"])
+
+    def test_successful_probe_clears_failure(self):
+        base_url, server = stand_in_server()
+        self.addCleanup(server.shutdown)
+        self.use_hosts([base_url])
+        upstream.mark_upstream_failure(base_url)
+        with mock.patch.object(upstream, "ACCOUNTS", [ACCOUNT]):
+            upstream.probe_all()
+        self.assertTrue(upstream.upstream_stats[base_url]["healthy"])
+        self.assertIsNone(upstream.upstream_stats[base_url]["failed_at"])
+
+
+class ProbeTests(UpstreamTestCase):
+    def test_probe_measures_a_working_host(self):
+        base_url, server = stand_in_server()
+        self.addCleanup(server.shutdown)
+        stats = upstream.probe_host(base_url, ACCOUNT)
+        self.assertTrue(stats["healthy"])
+        self.assertGreater(stats["throughput"], 0)
+        self.assertGreaterEqual(stats["ttfb"], 0)
+
+    def test_probe_reports_server_errors_and_dead_hosts(self):
+        base_url, server = stand_in_server(status=502)
+        self.addCleanup(server.shutdown)
+        self.assertFalse(upstream.probe_host(base_url, ACCOUNT)["healthy"])
+        self.assertFalse(upstream.probe_host(closed_port_url(), ACCOUNT, timeout=1)["healthy"])
+
+    def test_slower_host_ranks_after_faster_one(self):
+        fast_url, fast = stand_in_server()
+        slow_url, slow = stand_in_server(delay=0.3)
+        self.addCleanup(fast.shutdown)
+        self.addCleanup(slow.shutdown)
+        self.use_hosts([slow_url, fast_url])
+        with mock.patch.object(upstream, "ACCOUNTS", [ACCOUNT]):
+            upstream.probe_all()
+        self.assertEqual(upstream.ranked_hosts(ACCOUNT), [fast_url, slow_url])
+
+
+class FailoverTests(UpstreamTestCase):
+    def test_server_failure_classification(self):
+        def http_error(status):
+            response = requests.Response()
+            response.status_code = status
+            return requests.HTTPError(response=response)
+
+        self.assertTrue(upstream.is_server_failure(requests.ConnectionError()))
+        self.assertTrue(upstream.is_server_failure(requests.Timeout()))
+        self.assertTrue(upstream.is_server_failure(http_error(503)))
+        self.assertFalse(upstream.is_server_failure(http_error(401)))
+        self.assertFalse(upstream.is_server_failure(http_error(404)))
+
+    def test_download_fails_over_and_only_benches_server_side_failures(self):
+        unauthorized_url, unauthorized = stand_in_server(status=401)
+        broken_url, broken = stand_in_server(status=502)
+        working_url, working = stand_in_server()
+        for server in (unauthorized, broken, working):
+            self.addCleanup(server.shutdown)
+        dead_url = closed_port_url()
+        self.use_hosts([dead_url, unauthorized_url, broken_url, working_url])
+
+        file_path = os.path.join(self.workdir, "playlist.m3u")
+        self.assertEqual(downloader.download_m3u(ACCOUNT, file_path), file_path)
+        self.assertTrue(os.path.getsize(file_path))
+        self.assertEqual(set(upstream.upstream_stats), {dead_url, broken_url})
+        self.assertNotIn(unauthorized_url, upstream.upstream_stats)
+
+    def test_failed_download_leaves_no_partial_file(self):
+        broken_url, broken = stand_in_server(status=500)
+        self.addCleanup(broken.shutdown)
+        self.use_hosts([broken_url])
+        file_path = os.path.join(self.workdir, "guide.xml")
+        self.assertIsNone(downloader.download_epg(ACCOUNT, file_path))
+        self.assertFalse(os.path.exists(file_path))
+
+    def test_check_upstream_blames_the_host_only_for_server_failures(self):
+        missing_url, missing = stand_in_server(status=404)
+        broken_url, broken = stand_in_server(status=503)
+        self.addCleanup(missing.shutdown)
+        self.addCleanup(broken.shutdown)
+        self.assertFalse(upstream.check_upstream(f"{missing_url}/u/p/junk"))
+        self.assertTrue(upstream.check_upstream(f"{broken_url}/u/p/1"))
+        self.assertTrue(upstream.check_upstream(f"{closed_port_url()}/u/p/1", timeout=1))
+
+
+if __name__ == "__main__":
+    unittest.main()